@@ -0,0 +1,94 @@
+import asyncio
+import time
+from BungieClient import BungieThrottleError
+
+
+class AdaptiveLimiter:
+    # Semaphore whose size follows AIMD: it grows by roughly one slot per window of fast, successful
+    # requests and halves when requests are throttled, fail or get slower than the latency target.
+    def __init__(self, name, initial, minimum, maximum, latency_target, decrease_factor=0.5):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.completed = 0
+        self.throttled = 0
+        self.errors = 0
+        self.slow = 0
+        self.decreases = 0
+        self.total_latency = 0.0
+        self.last_decrease = 0.0
+        self._condition = None
+        self._loop = None
+
+    def _get_condition(self):
+        # asyncio primitives belong to the loop they are first used on
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+            self.in_flight = 0
+        return self._condition
+
+    def _record(self, latency, outcome):
+        self.completed += 1
+        self.total_latency += latency
+        if outcome == 'throttled':
+            self.throttled += 1
+        elif outcome == 'error':
+            self.errors += 1
+        elif latency > self.latency_target:
+            self.slow += 1
+            outcome = 'slow'
+
+        now = time.monotonic()
+        if outcome == 'success':
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        elif now - self.last_decrease > self.latency_target:
+            # Cut at most once per latency window so one burst of failures doesn't collapse the limit
+            self.limit = max(self.minimum, self.limit * self.decrease_factor)
+            self.last_decrease = now
+            self.decreases += 1
+
+    async def run(self, function, *args, **kwargs):
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+        start = time.monotonic()
+        outcome = 'success'
+        try:
+            return await function(*args, **kwargs)
+        except BungieThrottleError:
+            outcome = 'throttled'
+            raise
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            async with condition:
+                self.in_flight -= 1
+                self._record(time.monotonic() - start, outcome)
+                condition.notify_all()
+
+    def metrics(self):
+        return {
+            'name': self.name,
+            'limit': int(self.limit),
+            'minimum': self.minimum,
+            'maximum': self.maximum,
+            'in_flight': self.in_flight,
+            'peak_in_flight': self.peak_in_flight,
+            'completed': self.completed,
+            'throttled': self.throttled,
+            'errors': self.errors,
+            'slow': self.slow,
+            'decreases': self.decreases,
+            'avg_latency_ms': round(1000 * self.total_latency / self.completed, 1) if self.completed else None
+        }
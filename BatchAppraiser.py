@@ -0,0 +1,85 @@
+import weakref
+import numpy as np
+from GodRollIndex import GODROLL_COLUMNS
+
+HASH_LIMIT = 1 << 32  # Destiny definition hashes are unsigned 32-bit integers
+EMPTY_PLUGS = [-1] * GODROLL_COLUMNS
+
+_weight_tables = weakref.WeakKeyDictionary()  # GodRollIndex -> WeightTable, rebuilt whenever the index reloads
+
+
+class WeightTable:
+    def __init__(self, godroll_index):
+        self.rows = {}  # weaponHash -> row in the table
+        perk_hashes = set()
+        for weapon_hash, columns in godroll_index.rolls.items():
+            self.rows[weapon_hash] = len(self.rows)
+            for column in columns:
+                perk_hashes.update(column)
+
+        # Dense rows x columns x perks weight table; the extra last perk slot stands for "no match"
+        self.perks = np.array(sorted(perk_hashes), dtype=np.int64)
+        perk_ids = {perk_hash: perk_id for perk_id, perk_hash in enumerate(self.perks.tolist())}
+        self.weights = np.zeros((len(self.rows) + 1, GODROLL_COLUMNS, len(self.perks) + 1), dtype=np.uint8)
+        for weapon_hash, columns in godroll_index.rolls.items():
+            row = self.rows[weapon_hash]
+            for column_index, column in enumerate(columns):
+                for perk_hash, weight in column.items():
+                    self.weights[row, column_index, perk_ids[perk_hash]] = weight
+
+    def perk_ids(self, plugs):
+        # Map perk hashes to their slot in the table, unknown perks to the trailing "no match" slot
+        ids = np.searchsorted(self.perks, plugs)
+        ids = np.minimum(ids, len(self.perks))
+        known = ids < len(self.perks)
+        known[known] = self.perks[ids[known]] == plugs[known]
+        return np.where(known, ids, len(self.perks))
+
+
+def get_weight_table(godroll_index):
+    table = _weight_tables.get(godroll_index)
+    if table is None:
+        table = WeightTable(godroll_index)
+        _weight_tables[godroll_index] = table
+    return table
+
+
+def perk_hash_array(inv):
+    socket_hashes = [invweapon['socketHashes'] for invweapon in inv]
+    try:
+        return np.array(socket_hashes, dtype=np.int64).reshape(len(inv), GODROLL_COLUMNS)
+    except (TypeError, ValueError, OverflowError):
+        # Placeholders such as 'No plugHash found' or short socket lists, normalise them row by row
+        return np.array([
+            [socket_hash if isinstance(socket_hash, int) and 0 <= socket_hash < HASH_LIMIT else -1
+             for socket_hash in (list(hashes[:GODROLL_COLUMNS]) + EMPTY_PLUGS)[:GODROLL_COLUMNS]]
+            for hashes in socket_hashes
+        ], dtype=np.int64)
+
+
+def appraise_batch(inv, godroll_index):
+    table = get_weight_table(godroll_index)
+    weapon_count = len(inv)
+    if weapon_count == 0:
+        return inv
+
+    # N x 4 perk hashes and the god roll row for each weapon, the trailing empty row for weapons without one
+    no_godroll = len(table.rows)
+    row_lookup = table.rows.get
+    rows = np.fromiter((row_lookup(int(invweapon['weaponHash']), no_godroll) for invweapon in inv), dtype=np.int64, count=weapon_count)
+    plugs = table.perk_ids(perk_hash_array(inv))
+
+    # Gather every (weapon, god roll column, perk) weight at once: N x columns x perks
+    weights = table.weights[rows[:, None, None], np.arange(GODROLL_COLUMNS)[None, :, None], plugs[:, None, :]]
+
+    # Highest weight per god roll column, a weight of 100 being a first option match
+    group_weights = weights.max(axis=2).astype(np.int64)
+    match_counts = (group_weights == 100).sum(axis=1)
+    total_percentages = (group_weights.sum(axis=1) / 400) * 100
+
+    for invweapon, match_count, total_percentage, row in zip(inv, match_counts.tolist(), total_percentages.tolist(), rows.tolist()):
+        invweapon['score'] = f"{match_count}/4"
+        invweapon['total_percentage'] = total_percentage if row != no_godroll else 0
+        invweapon['score_float'] = match_count / 4
+
+    return inv
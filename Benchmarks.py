@@ -0,0 +1,201 @@
+# Local benchmarks for the hot paths. Run with the same environment as the function app, e.g.
+#   python Benchmarks.py appraisal --weapons 1000
+import argparse
+import copy
+import random
+import time
+from GodRollIndex import GodRollIndex
+
+
+def synthetic_godrolls(weapon_count, perk_pool, rng):
+    godrolls = []
+    for weapon_hash in range(weapon_count):
+        sockets_details = []
+        for _ in range(4):
+            options = rng.sample(perk_pool, 6)
+            sockets_details.append([{'name': str(perk), 'percentage': '10%', 'socketHash': {'$numberLong': str(perk)}} for perk in options])
+        godrolls.append({'weaponHash': weapon_hash, 'sockets_details': sockets_details})
+    return godrolls
+
+
+def synthetic_inventory(weapon_count, godroll_count, perk_pool, rng):
+    return [{
+        'itemId': str(item_id),
+        'weaponHash': rng.randrange(godroll_count + godroll_count // 10),  # Some weapons have no god roll
+        'socketHashes': [rng.choice(perk_pool) for _ in range(4)]
+    } for item_id in range(weapon_count)]
+
+
+def time_call(function, inv, rounds):
+    best = None
+    for _ in range(rounds):
+        weapons = copy.deepcopy(inv)
+        start = time.perf_counter()
+        result = function(weapons)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark_appraisal(weapon_count=1000, godroll_count=800, rounds=5, seed=42):
+    from InventoryReader import appraise_inv_parallel, appraise_inv_batch
+
+    rng = random.Random(seed)
+    perk_pool = [rng.randrange(1, 1 << 32) for _ in range(400)]
+    godroll_index = GodRollIndex.from_documents(synthetic_godrolls(godroll_count, perk_pool, rng))
+    inv = synthetic_inventory(weapon_count, godroll_count, perk_pool, rng)
+
+    appraise_batch = lambda weapons: appraise_inv_batch(weapons, 0, 0, None, godroll_index)
+    appraise_batch(copy.deepcopy(inv))  # Build the weight table outside the timed runs
+
+    loop_time, loop_result = time_call(lambda weapons: appraise_inv_parallel(weapons, 0, 0, None, godroll_index), inv, rounds)
+    batch_time, batch_result = time_call(appraise_batch, inv, rounds)
+
+    fields = ('itemId', 'score', 'score_float', 'total_percentage')
+    loop_scores = sorted(tuple(weapon[field] for field in fields) for weapon in loop_result['weapons'])
+    batch_scores = sorted(tuple(weapon[field] for field in fields) for weapon in batch_result['weapons'])
+    if loop_scores != batch_scores:
+        raise AssertionError("Batch appraisal produced different scores to appraise_inv_parallel")
+
+    print(f"Appraised {weapon_count} weapons against {godroll_count} god rolls (best of {rounds})")
+    print(f"  appraise_inv_parallel: {loop_time * 1000:.2f} ms")
+    print(f"  appraise_inv_batch:    {batch_time * 1000:.2f} ms ({loop_time / batch_time:.1f}x)")
+
+
+def synthetic_item_responses(weapon_count, rng):
+    # Per-item responses shaped like Bungie's item components, as extract_item_details receives them
+    user_inventory = {}
+    for item_id in range(weapon_count):
+        instance_id = str(6917529000000000000 + item_id)
+        user_inventory[instance_id] = {'Response': {
+            'characterId': '2305843009000000001',
+            'item': {'data': {'itemHash': rng.randrange(1, 200), 'itemInstanceId': instance_id}},
+            'instance': {'data': {
+                'damageType': 1, 'damageTypeHash': 3373582085, 'primaryStat': {'statHash': 1480404414, 'value': 2000},
+                'itemLevel': 200, 'quality': 0, 'isEquipped': False, 'canEquip': True, 'equipRequiredLevel': 50,
+                'unlockHashesRequiredToEquip': [2166136261], 'cannotEquipReason': 0, 'breakerType': 0, 'energy': None
+            }},
+            'sockets': {'data': {'sockets': [
+                {'plugHash': rng.randrange(1, 1 << 32), 'isEnabled': True, 'isVisible': True} for _ in range(12)
+            ]}},
+            'stats': {'data': {'stats': {
+                str(stat_hash): {'statHash': stat_hash, 'value': rng.randrange(100)}
+                for stat_hash in (155624089, 943549884, 1240592695, 1345609583, 2714457168, 3614673599, 3871231066, 4043523819, 4188031367)
+            }}}
+        }}
+    return user_inventory
+
+
+def benchmark_weapon_records(weapon_count=1000, seed=42):
+    import gc
+    import tracemalloc
+    from bson import BSON
+    import InventoryReader
+    from CompactWeapon import to_documents
+
+    godroll_index = GodRollIndex.from_documents([])
+    weapon_details = {weapon_hash: {'name': f'Weapon {weapon_hash}', 'icon': f'/icons/{weapon_hash}.jpg'} for weapon_hash in range(1, 200)}
+
+    print(f"Weapon records for {weapon_count} weapons")
+    for record_format in ('full', 'compact'):
+        InventoryReader.WEAPON_RECORD_FORMAT = record_format
+        gc.collect()
+        tracemalloc.start()
+        user_inventory = synthetic_item_responses(weapon_count, random.Random(seed))
+        weapons = InventoryReader.extract_item_details(user_inventory, weapon_details, None)
+        InventoryReader.appraise_inv_batch(weapons, 0, 0, None, godroll_index)
+        del user_inventory  # Whatever the records don't reference can now be freed
+        gc.collect()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        documents = to_documents(weapons)
+        stored = sum(len(BSON.encode(document)) for document in documents)
+        print(f"  {record_format:7}  stored {stored / weapon_count:7.0f} B/weapon  "
+              f"held in memory {retained / weapon_count:7.0f} B/weapon  peak {peak / 1e6:6.1f} MB")
+
+
+def synthetic_weapon_page(weapon_id, rng, filler_rows=1500):
+    # Stand-in for a light.gg item page: the three sections we read surrounded by page chrome
+    sockets = ''.join(
+        '<ul class="list-unstyled sockets">' + ''.join(
+            f'<li><div class="item"><img src="/perks/{column}{index}.png" alt="Perk {column}{index}"/></div>'
+            f'<div class="percent">{rng.randrange(100)}%</div></li>' for index in range(8)) + '</ul>'
+        for column in 'ABCD')
+    blocks = lambda kind: ''.join(
+        f'<div class="clearfix"><div class="perk-container"><div class="item" data-id="{kind}{index}">'
+        f'<img src="/{kind}/{index}.png" alt="{kind} {index}"/></div></div><div class="combo-percent">{rng.randrange(100)}%</div></div>'
+        for index in range(6))
+    chrome = ''.join(f'<div class="row"><div class="col-md-4"><a href="/db/items/{index}">Item {index}</a>'
+                     f'<span class="stat-value">{rng.random():.4f}</span><p>Review text {index}</p></div></div>'
+                     for index in range(filler_rows))
+    return (f'<html><head><title>Weapon {weapon_id}</title></head><body><nav>{chrome}</nav>'
+            f'<div id="community-average">{sockets}</div><div id="masterwork-stats">{blocks("mw")}</div>'
+            f'<div id="mod-stats">{blocks("mod")}</div><footer>{chrome}</footer></body></html>')
+
+
+def load_page_fixtures(fixtures_dir, page_count, seed=42):
+    # Saved pages named <weaponHash>.html, or synthetic pages when no directory is given
+    import pathlib
+    if fixtures_dir:
+        paths = sorted(pathlib.Path(fixtures_dir).glob('*.html'))[:page_count]
+        return [(int(path.stem) if path.stem.isdigit() else 0, path.read_text(encoding='utf-8')) for path in paths]
+    rng = random.Random(seed)
+    return [(weapon_id, synthetic_weapon_page(weapon_id, rng)) for weapon_id in range(page_count)]
+
+
+def benchmark_godroll_parse(fixtures_dir=None, page_count=20, rounds=3):
+    import tracemalloc
+    from GodRollParser import parse_weapon_page
+
+    pages = load_page_fixtures(fixtures_dir, page_count)
+    if not pages:
+        raise SystemExit(f"No .html fixtures found in {fixtures_dir}")
+    total_bytes = sum(len(html) for _, html in pages)
+
+    results = {}
+    print(f"Parsed {len(pages)} pages, {total_bytes / len(pages) / 1024:.0f} KB on average (best of {rounds})")
+    for label, strained in (('full', False), ('strained', True)):
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            results[label] = [parse_weapon_page(html, weapon_id, strained) for weapon_id, html in pages]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        # Peak memory of a single parse, the largest page being the worst case
+        weapon_id, html = max(pages, key=lambda page: len(page[1]))
+        tracemalloc.start()
+        parse_weapon_page(html, weapon_id, strained)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"  {label:8}  {len(pages) / best:7.1f} pages/s  {total_bytes / best / 1e6:6.2f} MB/s  peak {peak / 1e6:6.2f} MB per parse")
+
+    if results['full'] != results['strained']:
+        raise AssertionError("Strained parse extracted different god roll details to the full parse")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="RollRadar benchmarks")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    appraisal_parser = subparsers.add_parser('appraisal', help="Per-weapon vs batch god roll appraisal")
+    appraisal_parser.add_argument('--weapons', type=int, default=1000)
+    appraisal_parser.add_argument('--godrolls', type=int, default=800)
+    appraisal_parser.add_argument('--rounds', type=int, default=5)
+
+    records_parser = subparsers.add_parser('records', help="Full vs compact appraised weapon records")
+    records_parser.add_argument('--weapons', type=int, default=1000)
+
+    parse_parser = subparsers.add_parser('godroll-parse', help="Full vs strained light.gg page parse")
+    parse_parser.add_argument('--fixtures', help="Directory of saved light.gg item pages (<weaponHash>.html)")
+    parse_parser.add_argument('--pages', type=int, default=20)
+    parse_parser.add_argument('--rounds', type=int, default=3)
+
+    args = parser.parse_args()
+    if args.benchmark == 'appraisal':
+        benchmark_appraisal(args.weapons, args.godrolls, args.rounds)
+    elif args.benchmark == 'records':
+        benchmark_weapon_records(args.weapons)
+    elif args.benchmark == 'godroll-parse':
+        benchmark_godroll_parse(args.fixtures, args.pages, args.rounds)
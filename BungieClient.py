@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from RateLimiter import TokenBucket
+
+API_KEY = os.environ.get('API_KEY')  # Bungie API key
+BUNGIE_ROOT = 'https://www.bungie.net'
+PLATFORM_ROOT = f'{BUNGIE_ROOT}/Platform'
+
+BUNGIE_RATE_LIMIT = float(os.environ.get('BUNGIE_RATE_LIMIT', 20))  # Requests per second per worker
+BUNGIE_BURST = int(os.environ.get('BUNGIE_BURST', 40))  # Requests allowed back to back before the rate applies
+BUNGIE_MAX_RETRIES = int(os.environ.get('BUNGIE_MAX_RETRIES', 3))  # Retries after the first attempt
+BUNGIE_POOL_SIZE = int(os.environ.get('BUNGIE_POOL_SIZE', 50))  # Keep-alive connections per worker
+BUNGIE_TIMEOUT = float(os.environ.get('BUNGIE_TIMEOUT', 30))  # Seconds per request
+RETRY_BASE_DELAY = 0.5  # Seconds, doubled on every retry before jitter
+RETRY_MAX_DELAY = 10  # Seconds
+
+SUCCESS_ERROR_CODE = 1
+MAINTENANCE_ERROR_CODES = {5}  # SystemDisabled
+AUTH_ERROR_CODES = {99, 2108}  # WebAuthRequired, AccessTokenHasExpired
+THROTTLE_ERROR_CODES = {
+    36,  # ThrottleLimitExceededMinutes
+    37,  # ThrottleLimitExceededMomentarily
+    38,  # ThrottleLimitExceededSeconds
+    51,  # DestinyThrottledByGameServer
+    1672,  # PerApplicationThrottleExceeded
+    1673,  # PerApplicationAnonymousThrottleExceeded
+    1674,  # PerApplicationAuthenticatedThrottleExceeded
+    1675,  # PerUserThrottleExceeded
+}
+
+
+class BungieApiError(Exception):
+    retryable = False
+
+    def __init__(self, message, status=None, error_code=None, error_status=None):
+        super().__init__(message)
+        self.status = status
+        self.error_code = error_code
+        self.error_status = error_status
+
+
+class BungieThrottleError(BungieApiError):
+    retryable = True
+
+    def __init__(self, message, throttle_seconds=0, **kwargs):
+        super().__init__(message, **kwargs)
+        self.throttle_seconds = throttle_seconds
+
+
+class BungieServerError(BungieApiError):
+    retryable = True
+
+
+class BungieConnectionError(BungieApiError):
+    retryable = True
+
+
+class BungieAuthError(BungieApiError):
+    pass
+
+
+class BungieMaintenanceError(BungieApiError):
+    pass
+
+
+def check_response(url, status, body):
+    # Turn a Bungie response into its JSON body or the matching typed error
+    error_code = body.get('ErrorCode') if isinstance(body, dict) else None
+    if status == 200 and error_code in (None, SUCCESS_ERROR_CODE):
+        return body
+
+    error_status = body.get('ErrorStatus') if isinstance(body, dict) else None
+    message = f"Bungie request to {url} failed with status {status}"
+    if error_status:
+        message += f" ({error_status}: {body.get('Message')})"
+    details = {'status': status, 'error_code': error_code, 'error_status': error_status}
+
+    if status == 429 or error_code in THROTTLE_ERROR_CODES:
+        throttle_seconds = body.get('ThrottleSeconds', 0) if isinstance(body, dict) else 0
+        raise BungieThrottleError(message, throttle_seconds=throttle_seconds or 0, **details)
+    if error_code in MAINTENANCE_ERROR_CODES:
+        raise BungieMaintenanceError(message, **details)
+    if status == 401 or error_code in AUTH_ERROR_CODES:
+        raise BungieAuthError(message, **details)
+    if status >= 500:
+        raise BungieServerError(message, **details)
+    raise BungieApiError(message, **details)
+
+
+def retry_delay(attempt, error):
+    # Full jitter backoff, never shorter than the throttle window Bungie asked for
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+    if isinstance(error, BungieThrottleError):
+        delay = max(delay, error.throttle_seconds)
+    return delay
+
+
+class BungieClient:
+    # One per API key per worker, so keep-alive connections and the rate limit are shared by every invocation
+    def __init__(self, api_key, rate=BUNGIE_RATE_LIMIT, burst=BUNGIE_BURST, max_retries=BUNGIE_MAX_RETRIES):
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.limiter = TokenBucket(rate, burst)
+        self._local = threading.local()  # requests sessions aren't thread safe, so each thread gets its own
+        self._async_session = None
+        self._async_loop = None
+
+    def url(self, path):
+        return path if path.startswith('http') else f'{PLATFORM_ROOT}{path}'
+
+    def headers(self, access_token=None, headers=None):
+        request_headers = {'X-API-Key': self.api_key}
+        if access_token:
+            request_headers['Authorization'] = f'Bearer {access_token}'
+        if headers:
+            request_headers.update(headers)
+        return request_headers
+
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=BUNGIE_POOL_SIZE)
+            session.mount('https://', adapter)
+            self._local.session = session
+        return session
+
+    async def async_session(self):
+        # aiohttp sessions are tied to the event loop they were created on
+        loop = asyncio.get_running_loop()
+        if self._async_session is None or self._async_session.closed or self._async_loop is not loop:
+            previous, previous_loop = self._async_session, self._async_loop
+            connector = aiohttp.TCPConnector(limit=BUNGIE_POOL_SIZE, keepalive_timeout=60)
+            self._async_session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=BUNGIE_TIMEOUT))
+            self._async_loop = loop
+            # Close the session left by a finished loop so its connector isn't leaked
+            if previous is not None and not previous.closed and not previous_loop.is_running():
+                await previous.close()
+        return self._async_session
+
+    def _on_retry(self, url, attempt, error):
+        delay = retry_delay(attempt, error)
+        if isinstance(error, BungieThrottleError):
+            self.limiter.pause(delay)
+        logging.warning(f"Retrying {url} in {delay:.2f}s after attempt {attempt + 1}: {error}")
+        return delay
+
+    def request(self, method, path, access_token=None, headers=None, **kwargs):
+        url = self.url(path)
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            try:
+                response = self.session().request(method, url, headers=self.headers(access_token, headers), timeout=BUNGIE_TIMEOUT, **kwargs)
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = None
+                return check_response(url, response.status_code, body)
+            except requests.RequestException as e:
+                error = BungieConnectionError(f"Bungie request to {url} failed: {e}")
+            except BungieApiError as e:
+                error = e
+
+            if not error.retryable or attempt == self.max_retries:
+                raise error
+            time.sleep(self._on_retry(url, attempt, error))
+
+    def get(self, path, access_token=None, **kwargs):
+        return self.request('GET', path, access_token, **kwargs)
+
+    def post(self, path, access_token=None, **kwargs):
+        return self.request('POST', path, access_token, **kwargs)
+
+    def download(self, url):
+        # Streaming GET for non-JSON content such as the manifest database, over the pooled session
+        self.limiter.acquire()
+        return self.session().get(self.url(url), stream=True, timeout=BUNGIE_TIMEOUT)
+
+    async def request_async(self, method, path, access_token=None, headers=None, **kwargs):
+        url = self.url(path)
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire_async()
+            try:
+                session = await self.async_session()
+                async with session.request(method, url, headers=self.headers(access_token, headers), **kwargs) as response:
+                    try:
+                        body = await response.json(content_type=None)
+                    except ValueError:
+                        body = None
+                    return check_response(url, response.status, body)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = BungieConnectionError(f"Bungie request to {url} failed: {e!r}")
+            except BungieApiError as e:
+                error = e
+
+            if not error.retryable or attempt == self.max_retries:
+                raise error
+            await asyncio.sleep(self._on_retry(url, attempt, error))
+
+    async def get_async(self, path, access_token=None, **kwargs):
+        return await self.request_async('GET', path, access_token, **kwargs)
+
+    def for_user(self, access_token):
+        return BungieUserClient(self, access_token)
+
+
+class BungieUserClient:
+    # Binds a user's OAuth token to the shared client for the calls made during one scan
+    def __init__(self, client, access_token):
+        self.client = client
+        self.access_token = access_token
+
+    async def get(self, path, **kwargs):
+        return await self.client.get_async(path, self.access_token, **kwargs)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_bungie_client(api_key=API_KEY):
+    with _clients_lock:
+        if api_key not in _clients:
+            _clients[api_key] = BungieClient(api_key)
+        return _clients[api_key]
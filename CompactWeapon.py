@@ -0,0 +1,90 @@
+import os
+from array import array
+
+WEAPON_RECORD_FORMAT = os.environ.get('WEAPON_RECORD_FORMAT', 'full')  # 'full' keeps Bungie's raw components, 'compact' keeps CompactWeapon fields only
+INSTANCE_FIELDS = ('damageType', 'damageTypeHash', 'primaryStat', 'itemLevel', 'quality', 'isEquipped', 'canEquip')  # Instance fields the app shows
+MISSING_PLUG = 'No plugHash found'
+
+
+class CompactWeapon:
+    # In-memory appraised weapon: plug and stat hashes live in typed arrays instead of Bungie's nested dicts.
+    # Item access by the record's field names lets the appraisal code treat it like the full dict record.
+    __slots__ = ('itemId', 'weaponHash', 'characterId', 'weaponName', 'weaponType', 'icon', 'instance',
+                 'plugHashes', 'statHashes', 'statValues', 'score', 'total_percentage', 'score_float')
+
+    def __init__(self, itemId, weaponHash, characterId, weaponName, weaponType, icon, instance, plugHashes, statHashes, statValues):
+        self.itemId = itemId
+        self.weaponHash = weaponHash
+        self.characterId = characterId
+        self.weaponName = weaponName
+        self.weaponType = weaponType
+        self.icon = icon
+        self.instance = instance
+        self.plugHashes = plugHashes  # array('I') of every socket's plug, 0 for an empty socket
+        self.statHashes = statHashes  # array('I')
+        self.statValues = statValues  # array('i'), parallel to statHashes
+        self.score = None
+        self.total_percentage = None
+        self.score_float = None
+
+    @classmethod
+    def from_components(cls, item_details, sockets_details, instance_details, stats_details, weapon_info, characterId=None):
+        sockets_details = sockets_details or []
+        # Sockets 1-4 are scored, an empty one there raises KeyError so the weapon is skipped as with the full record
+        for socket in sockets_details[1:5]:
+            socket['plugHash']
+        stats = (stats_details or {}).get('stats', {})
+
+        return cls(
+            itemId=item_details.get('itemInstanceId', 'No itemInstanceId found'),
+            weaponHash=item_details.get('itemHash', 'No itemHash found'),
+            characterId=characterId,
+            weaponName=weapon_info.get('name', 'N/A'),
+            weaponType=weapon_info.get('type'),
+            icon=weapon_info.get('icon', 'N/A'),
+            instance={field: instance_details[field] for field in INSTANCE_FIELDS if field in instance_details} if instance_details else 'N/A',
+            plugHashes=array('I', (socket.get('plugHash', 0) for socket in sockets_details)),
+            statHashes=array('I', (stat['statHash'] for stat in stats.values())),
+            statValues=array('i', (stat.get('value', 0) for stat in stats.values()))
+        )
+
+    @property
+    def socketHashes(self):
+        return [self.plugHashes[i] if i < len(self.plugHashes) else MISSING_PLUG for i in range(1, 5)]
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def to_document(self):
+        # Slim Mongo and JSON schema, stat hashes become string keys since document keys must be strings
+        document = {
+            'itemId': self.itemId,
+            'weaponHash': self.weaponHash,
+            'weaponName': self.weaponName,
+            'weaponType': self.weaponType,
+            'icon': self.icon,
+            'instance': self.instance,
+            'socketHashes': self.socketHashes,
+            'plugHashes': self.plugHashes.tolist(),
+            'stats': {str(stat_hash): value for stat_hash, value in zip(self.statHashes, self.statValues)},
+            'score': self.score,
+            'total_percentage': self.total_percentage,
+            'score_float': self.score_float
+        }
+        if self.characterId is not None:
+            document['characterId'] = self.characterId
+        return document
+
+
+def to_documents(weapons):
+    # Plain dicts for MongoDB and JSON, whichever record format the scan used
+    return [weapon.to_document() if isinstance(weapon, CompactWeapon) else weapon for weapon in weapons]
@@ -1,8 +1,9 @@
 import logging
 import datetime
-from GetManifest import download_destiny_manifest
-from GetAllWeapons import GetWeapons
-from GetAllPerks import GetPerks
+from GetManifest import download_destiny_manifest, get_ingested_manifest, get_manifest_metadata, record_ingested_manifest
+from GetAllWeapons import save_weapons_to_mongodb
+from GetAllPerks import save_perks_to_mongodb
+from ManifestExtractor import extract_manifest
 import os
 import json
 from azure.storage.queue import (
@@ -18,21 +19,44 @@ CLIENT_SECRET = os.environ["CLIENT_SECRET"]
 MONGODB_URI = os.environ["MONGODB_URI"]
 STORAGE_CONNECTION_STRING = os.environ['AzureWebJobsStorage']  # Azure Storage connection string
 QUEUE_NAME = 'godrollqueue'  # Azure Queue name
+FORCE_MANIFEST_REFRESH = os.environ.get('FORCE_MANIFEST_REFRESH', 'false').lower() == 'true'  # Re-ingest even if the version is unchanged
 
-def DailyRefreshCore(db) -> None:
+def manifest_changed(manifest, ingested):
+    return manifest['version'] != ingested.get('version') or manifest['path'] != ingested.get('path')
+
+def DailyRefreshCore(db, force=FORCE_MANIFEST_REFRESH) -> None:
     logging.info('RollRadarDailyRefresh function started at %s', datetime.datetime.now())
         
     starttime = datetime.datetime.now()
     
-    tempfile_path = download_destiny_manifest(API_KEY) 
-    
-    GetWeapons(tempfile_path, db)
-    
-    GetPerks(tempfile_path, db)
+    manifest = get_manifest_metadata(API_KEY)
     
-    if os.path.isfile(tempfile_path):
-        os.remove(tempfile_path)
-        logging.info(f"Deleted temporary file")
+    if manifest is None:
+        logging.error("Could not read the manifest version, skipping definition refresh")
+    elif force or manifest_changed(manifest, get_ingested_manifest(db)):
+        logging.info(f"Ingesting manifest version {manifest['version']} (forced: {force})")
+        
+        tempfile_path = download_destiny_manifest(API_KEY, manifest) 
+        
+        if tempfile_path is None:
+            # Leave the version unrecorded so the next run tries again, the scrape still runs on the current definitions
+            logging.error(f"Could not download manifest version {manifest['version']}, skipping definition refresh")
+        else:
+            # Decode every item definition once and split it into weapons and perks
+            weapons, perks = extract_manifest(tempfile_path)
+            
+            save_weapons_to_mongodb(weapons, db)
+            
+            save_perks_to_mongodb(perks, db)
+            
+            # Tag the ingested definitions so worker caches reload them
+            record_ingested_manifest(db, manifest)
+            
+            if os.path.isfile(tempfile_path):
+                os.remove(tempfile_path)
+                logging.info(f"Deleted temporary file")
+    else:
+        logging.info(f"Manifest version {manifest['version']} already ingested, skipping download")
     
     logging.info("Starting Scraping...")
     
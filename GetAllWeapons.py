@@ -1,6 +1,4 @@
-import sqlite3
-import logging
-import json
+from MongoSync import sync_collection
 
 stat_name_lookup = {
     2223994109: "Aspect Energy Capacity",
@@ -80,49 +78,14 @@ ammo_name_lookup = {
     3: "Heavy"
 }
 
-def get_weapon_names_and_ids(db_path):
-    # Connect to the SQLite database
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    # Query to select weapon names and their ids (hashes)
-    query = """
-        SELECT DISTINCT 
-        json_extract(json, '$.hash') AS ItemHash, 
-        json_extract(json, '$.displayProperties.name') AS Name, 
-        json_extract(json, '$.itemTypeDisplayName') AS Type, 
-        json_extract(json, '$.inventory.tierTypeName') AS Rarity, 
-        json_extract(json, '$.damageTypes') AS DamageTypes, 
-        json_extract(json, '$.stats.stats') AS Stats,
-        json_extract(json, '$.equippingBlock.ammoType') AS AmmoType,
-        json_extract(json, '$.inventory.bucketTypeHash') AS WeaponSlot,
-        json_extract(json, '$.displaySource') AS AcquisitionSource,
-        json_extract(json, '$.loreHash') AS LoreHash,
-        json_extract(json, '$.displayProperties.icon') AS IconPath, 
-        json_extract(json, '$.iconWatermark') AS WatermarkPath,
-        json_extract(json, '$.screenshot') AS ScreenshotPath,
-        json_extract(json, '$.sockets') AS Sockets
-        FROM DestinyInventoryItemDefinition 
-        WHERE json_extract(json, '$.itemType') = 3 
-        AND json_extract(json, '$.displayProperties.name') IS NOT NULL 
-        ORDER BY json_extract(json, '$.displayProperties.name');
-        """
-
-    weapons = []
-    try:
-        cursor.execute(query)
-        weapons = cursor.fetchall()
-    finally:
-        # Make sure to close the database connection
-        conn.close()
-    
-    print(f"Found weapons details for {len(weapons)} weapons.")
-    return weapons
-
-def save_weapons_to_mongodb(weapons, db):
+def save_weapons_to_mongodb(weapons, db, sync=True):
     
     collection = db["WeaponDetails"]
     
+    if sync:
+        # Only write the weapons that were added, changed or removed
+        return sync_collection(collection, weapons, 'id')
+    
     # Insert the weapon data into the MongoDB collection
     collection.delete_many({})
 
@@ -132,113 +95,63 @@ def save_weapons_to_mongodb(weapons, db):
     print(f"Inserted {len(weapons)} weapons into MongoDB")
     
     
-import json
-
-def process_hashes(weapons):
-    processed_weapons = []
-    for weapon in weapons:
-        # Initialize the weapon dictionary directly from the weapon tuple
-        weapon_dict = {
-            "id": weapon[0], 
-            "name": weapon[1], 
-            "type": weapon[2], 
-            "rarity": weapon[3], 
-            "damageTypes": weapon[4], 
-            "stats": weapon[5],
-            "ammoType": weapon[6], 
-            "weaponSlot": weapon[7],
-            "acquisitionSource": weapon[8], 
-            "loreHash": weapon[9], 
-            "iconPath": weapon[10], 
-            "watermarkPath": weapon[11],
-            "screenshotPath": weapon[12],
-            "socket_types": weapon[13],
-            "randomRoll": False
-        }
-
-        # Attempt to decode the JSON string for stats
-        try:
-            weapon_stats_data = json.loads(weapon_dict["stats"])
-        except json.JSONDecodeError:
-            print(f"Error decoding JSON for weapon: {weapon_dict['name']}")
-            continue  # Skip this weapon if there's a problem with the stats JSON
-
-        # Process the stats to convert stat hashes to names
-        processed_stats = []
-        for stat_hash, stat_info in weapon_stats_data.items():
-            stat_hash_int = int(stat_hash)  # Convert hash to integer for lookup
-            stat_name = stat_name_lookup.get(stat_hash_int, None)
-            if stat_name is None:
-                continue  # Skip this stat if the name is unknown
-            value = stat_info.get('value', 'N/A')
-            minimum = stat_info.get('minimum', 'N/A')
-            maximum = stat_info.get('maximum', 'N/A')
-            display_maximum = stat_info.get('displayMaximum', 'N/A')
-            processed_stats.append({
-                'stat_hash': stat_hash_int,
-                'stat_name': stat_name,
-                'value': value,
-                'minimum': minimum,
-                'maximum': maximum,
-                'display_maximum': display_maximum
-            })
-            
-        processed_damage_types = []
-        damage_types = json.loads(weapon_dict["damageTypes"])
-        for damage_type in damage_types:
-            damage_type_info = damage_name_lookup.get(str(damage_type), f"Unknown Damage Type: {damage_type}")
-            # Convert the tuple to a list and append it
-            processed_damage_types.extend(damage_type_info)
-                      
-        ammo_type = weapon_dict["ammoType"]
-        ammo_type_name = ammo_name_lookup.get(ammo_type, f"Unknown Ammo Type: {ammo_type}")
+def process_decoded_weapon(weapon_dict, weapon_stats_data, damage_types, socket_data):
+    # Process the stats to convert stat hashes to names
+    processed_stats = []
+    for stat_hash, stat_info in weapon_stats_data.items():
+        stat_hash_int = int(stat_hash)  # Convert hash to integer for lookup
+        stat_name = stat_name_lookup.get(stat_hash_int, None)
+        if stat_name is None:
+            continue  # Skip this stat if the name is unknown
+        value = stat_info.get('value', 'N/A')
+        minimum = stat_info.get('minimum', 'N/A')
+        maximum = stat_info.get('maximum', 'N/A')
+        display_maximum = stat_info.get('displayMaximum', 'N/A')
+        processed_stats.append({
+            'stat_hash': stat_hash_int,
+            'stat_name': stat_name,
+            'value': value,
+            'minimum': minimum,
+            'maximum': maximum,
+            'display_maximum': display_maximum
+        })
         
-        processed_socket_types = []
-        random_roll = False
-        
-        # Attempt to decode the JSON string for sockets
-        try:
-            socket_data = json.loads(weapon_dict["socket_types"])
-            for socket_entry in socket_data.get('socketEntries', []):
-                socket_type_hash = socket_entry.get('socketTypeHash')
-                if socket_type_hash is not None:
-                    processed_socket_types.append(socket_type_hash)
-                if 'randomizedPlugSetHash' in socket_entry:
-                    random_roll = True
-        except json.JSONDecodeError:
-            print(f"Error decoding JSON for sockets in weapon: {weapon_dict['name']}")
-            
-        weaponSlot = weapon_dict["weaponSlot"]
+    processed_damage_types = []
+    for damage_type in damage_types:
+        damage_type_info = damage_name_lookup.get(str(damage_type), f"Unknown Damage Type: {damage_type}")
+        # Convert the tuple to a list and append it
+        processed_damage_types.extend(damage_type_info)
+                  
+    ammo_type = weapon_dict["ammoType"]
+    ammo_type_name = ammo_name_lookup.get(ammo_type, f"Unknown Ammo Type: {ammo_type}")
+    
+    processed_socket_types = []
+    random_roll = False
+    
+    if socket_data is not None:
+        for socket_entry in socket_data.get('socketEntries', []):
+            socket_type_hash = socket_entry.get('socketTypeHash')
+            if socket_type_hash is not None:
+                processed_socket_types.append(socket_type_hash)
+            if 'randomizedPlugSetHash' in socket_entry:
+                random_roll = True
         
-        if weaponSlot == 1498876634:
-            weaponSlot = "Primary"
-        elif weaponSlot == 2465295065:
-            weaponSlot = "Secondary"
-        elif weaponSlot == 953998645:
-            weaponSlot = "Heavy"
-            
-            
-        # Update weapon_dict with the processed stats
-        weapon_dict["stats"] = processed_stats
-        weapon_dict["damageTypes"] = processed_damage_types
-        weapon_dict["ammoType"] = ammo_type_name
-        weapon_dict["socket_types"] = processed_socket_types
-        weapon_dict["weaponSlot"] = weaponSlot
-        weapon_dict["randomRoll"] = random_roll
+    weaponSlot = weapon_dict["weaponSlot"]
+    
+    if weaponSlot == 1498876634:
+        weaponSlot = "Primary"
+    elif weaponSlot == 2465295065:
+        weaponSlot = "Secondary"
+    elif weaponSlot == 953998645:
+        weaponSlot = "Heavy"
         
-        # Append the updated dictionary to processed_weapons
-        processed_weapons.append(weapon_dict)
         
-
-    return processed_weapons
-
-def GetWeapons(temp_file_path, db):
-    # Path to your Destiny 2 Manifest database
-    db_path = temp_file_path
-    # Specify the path for the JSON file where the weapon names and ids will be stored
-
-    weapons = get_weapon_names_and_ids(db_path)
-    weapons_processed = process_hashes(weapons)
-    save_weapons_to_mongodb(weapons_processed, db)
-    logging.info(f"Saved {len(weapons)} weapons to MongoDB")
-    return weapons
\ No newline at end of file
+    # Update weapon_dict with the processed stats
+    weapon_dict["stats"] = processed_stats
+    weapon_dict["damageTypes"] = processed_damage_types
+    weapon_dict["ammoType"] = ammo_type_name
+    weapon_dict["socket_types"] = processed_socket_types
+    weapon_dict["weaponSlot"] = weaponSlot
+    weapon_dict["randomRoll"] = random_roll
+    
+    return weapon_dict
@@ -1,50 +1,92 @@
-import requests
-import io
 import zipfile
 import logging
 import tempfile
+import shutil
+import sys
+from RefreshState import get_refresh_state, set_refresh_state
+from BungieClient import BUNGIE_ROOT, BungieApiError, get_bungie_client
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, peak RSS is then reported as nan
+    resource = None
+
+MANIFEST_CHUNK_SIZE = 1024 * 1024  # Bytes per read while downloading and decompressing
+MANIFEST_SPOOL_SIZE = 8 * 1024 * 1024  # Compressed bodies larger than this are spooled to disk
 
 def upload_progress_callback(current, total):
     print(f"Uploaded {current} of {total} bytes ({(current/total)*100:.2f}%)")
 
 
-def download_destiny_manifest(api_key):
+def peak_rss_mb():
+    if resource is None:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def get_manifest_metadata(api_key):
+    try:
+        manifest_data = get_bungie_client(api_key).get("/Destiny2/Manifest/")
+    except BungieApiError as e:
+        logging.error(f"Failed to get the manifest location: {e}")
+        return None
+    
+    return {
+        'version': manifest_data['Response']['version'],
+        'path': manifest_data['Response']['mobileWorldContentPaths']['en']
+    }
+
+
+def get_ingested_manifest(db):
+    return get_refresh_state(db, 'Manifest')
+
+
+def record_ingested_manifest(db, manifest):
+    set_refresh_state(db, 'Manifest', version=manifest['version'], path=manifest['path'])
+    logging.info(f"Recorded ingested manifest version {manifest['version']}")
+
+
+def download_destiny_manifest(api_key, manifest=None):
     
     azure_logger = logging.getLogger('azure')
     azure_logger.setLevel(logging.WARNING)
     
-    manifest_url = "https://www.bungie.net/Platform/Destiny2/Manifest/"
-    container_name = "rollradar-functions"  # Replace with your actual container name
-    headers = {"X-API-Key": api_key}
+    if manifest is None:
+        manifest = get_manifest_metadata(api_key)
     
-    response = requests.get(manifest_url, headers=headers)
-    if response.status_code == 200:
-        manifest_data = response.json()
-        manifest_path = manifest_data['Response']['mobileWorldContentPaths']['en']
-        full_manifest_url = f"https://www.bungie.net{manifest_path}"
+    if manifest:
+        manifest_path = manifest['path']
+        full_manifest_url = f"{BUNGIE_ROOT}{manifest_path}"
         
-        manifest_response = requests.get(full_manifest_url, stream=True)
-        manifest_content = manifest_response.content
-        
-        logging.info(f"Downloaded manifest from: {full_manifest_url}")
-
-        with zipfile.ZipFile(io.BytesIO(manifest_content), 'r') as zip_ref:
-            manifest_names = [name for name in zip_ref.namelist() if name.endswith('.content')]
-            if manifest_names:
-                manifest_name = manifest_names[0]
-                with zip_ref.open(manifest_name) as manifest_file, tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                    manifest_data = manifest_file.read()
-                    temp_file.write(manifest_data)
-                    # Now temp_file.name contains the path to the temporary file where the manifest is stored.
-                    logging.info(f"Stored manifest temporarily at: {temp_file.name}")
-                    
-                    # You can now upload the manifest data from temp_file or use it directly
-                    manifest_name = manifest_name.replace('.content', '.sqlite3')
-                    logging.info(f"Extracted and uploaded manifest: {manifest_name}")
-                    return temp_file.name
-            else:
-                logging.error("No manifest file found in the ZIP.")
-    else:
-        logging.error("Failed to get the manifest location.")
+        with get_bungie_client(api_key).download(full_manifest_url) as manifest_response, \
+                tempfile.SpooledTemporaryFile(max_size=MANIFEST_SPOOL_SIZE) as compressed_file:
+            if manifest_response.status_code != 200:
+                logging.error(f"Failed to download manifest, status code: {manifest_response.status_code}")
+                return None
+
+            # Write the compressed body to disk in chunks rather than holding it in memory
+            for chunk in manifest_response.iter_content(chunk_size=MANIFEST_CHUNK_SIZE):
+                compressed_file.write(chunk)
+            compressed_file.seek(0)
+            
+            logging.info(f"Downloaded manifest from: {full_manifest_url}")
+
+            with zipfile.ZipFile(compressed_file, 'r') as zip_ref:
+                manifest_names = [name for name in zip_ref.namelist() if name.endswith('.content')]
+                if manifest_names:
+                    manifest_name = manifest_names[0]
+                    with zip_ref.open(manifest_name) as manifest_file, tempfile.NamedTemporaryFile(delete=False) as temp_file:
+                        # Decompress the SQLite database straight to disk
+                        shutil.copyfileobj(manifest_file, temp_file, MANIFEST_CHUNK_SIZE)
+                        # Now temp_file.name contains the path to the temporary file where the manifest is stored.
+                        logging.info(f"Stored manifest temporarily at: {temp_file.name}")
+                        
+                        manifest_name = manifest_name.replace('.content', '.sqlite3')
+                        logging.info(f"Extracted manifest: {manifest_name}, peak RSS: {peak_rss_mb():.1f} MB")
+                        return temp_file.name
+                else:
+                    logging.error("No manifest file found in the ZIP.")
 
 # Replace with your actual values
@@ -0,0 +1,101 @@
+import os
+from RefreshState import VersionedCache, get_refresh_state
+
+GODROLL_CHECK_INTERVAL = int(os.environ.get('GODROLL_CHECK_INTERVAL', 60))  # Seconds between GodRolls version checks
+GODROLL_COLUMNS = 4  # Only the first 4 socket groups of a god roll are scored
+
+
+def unwrap_hash(value):
+    # Hashes imported as extended JSON arrive as {'$numberLong': '...'} or {'$numberInt': '...'}
+    if isinstance(value, dict):
+        socket_hash_key = '$numberLong' if '$numberLong' in value else '$numberInt'
+        return int(value[socket_hash_key]) if socket_hash_key in value else None
+    elif isinstance(value, int):
+        return value
+    return None
+
+
+def compile_columns(sockets_details):
+    columns = []
+    for socket_group in sockets_details[:GODROLL_COLUMNS]:
+        column = {}
+        for index, socket_option in enumerate(socket_group):
+            # Weight the option based on its position, the first option being the god roll perk
+            weight = max(100 - (index * 25), 0)
+            socket_hash = unwrap_hash(socket_option.get('socketHash'))
+            if socket_hash is not None and weight > column.get(socket_hash, 0):
+                column[socket_hash] = weight
+        columns.append(column)
+    return tuple(columns)
+
+
+class GodRollIndex:
+    def __init__(self, rolls, version=None):
+        self.rolls = rolls  # weaponHash -> tuple of {perk hash: weight} columns
+        self.version = version
+
+    @classmethod
+    def from_documents(cls, godrolls, version=None):
+        rolls = {}
+        for godroll in godrolls:
+            weapon_hash = unwrap_hash(godroll.get('weaponHash'))
+            # Only the first god roll document for a weapon is scored
+            if weapon_hash is not None and weapon_hash not in rolls:
+                rolls[weapon_hash] = compile_columns(godroll.get('sockets_details') or [])
+        return cls(rolls, version)
+
+    def appraise(self, weapon_hash, socket_hashes):
+        columns = self.rolls.get(weapon_hash)
+        if columns is None:
+            return None
+
+        match_count = 0
+        total_weighted_percentage = 0
+        for column in columns:
+            # Take the highest weight any of the weapon's perks reaches in this group
+            group_weighted_percentage = 0
+            for socket_hash in socket_hashes:
+                weight = column.get(socket_hash, 0)
+                if weight > group_weighted_percentage:
+                    group_weighted_percentage = weight
+            if group_weighted_percentage == 100:
+                match_count += 1  # Only the first option of a group counts as a match
+            total_weighted_percentage += group_weighted_percentage
+
+        # Normalize total_weighted_percentage to a scale of 0-100
+        return match_count, (total_weighted_percentage / 400) * 100
+
+
+def process_weapon(invweapon, godroll_index):
+    invweapon['score'] = '0/4'  # Initialize the match score out of 4
+    total_percentage = 0  # Initialize the total percentage score
+
+    appraisal = godroll_index.appraise(int(invweapon['weaponHash']), invweapon['socketHashes'])
+    if appraisal is not None:
+        match_count, total_percentage = appraisal
+        invweapon['score'] = f"{match_count}/4"
+
+    invweapon['total_percentage'] = total_percentage
+    return invweapon
+
+
+def godrolls_version(db):
+    state = get_refresh_state(db, 'GodRolls')
+    if state.get('version') is not None:
+        return state['version']
+
+    # Fall back to a cheap fingerprint when the scraper has not stamped a version yet
+    latest = db['GodRolls'].find_one({}, {'_id': 1}, sort=[('_id', -1)])
+    return (db['GodRolls'].estimated_document_count(), latest['_id'] if latest else None)
+
+
+def load_godroll_index(db, version):
+    godrolls = db['GodRolls'].find({}, {'_id': 0, 'weaponHash': 1, 'sockets_details': 1})
+    return GodRollIndex.from_documents(godrolls, version)
+
+
+_godroll_index_cache = VersionedCache('GodRolls', load_godroll_index, godrolls_version, GODROLL_CHECK_INTERVAL)
+
+
+def get_godroll_index(db):
+    return _godroll_index_cache.get(db)
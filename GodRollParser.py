@@ -0,0 +1,96 @@
+from bs4 import BeautifulSoup, SoupStrainer
+
+SECTION_IDS = ['community-average', 'masterwork-stats', 'mod-stats']  # The only parts of a light.gg item page we read
+SECTION_STRAINER = SoupStrainer(id=SECTION_IDS)
+
+
+def extract_weapon_details(soup, weapon_id):
+    community_average_div = soup.find('div', id='community-average')
+    masterwork_div = soup.find('div', id='masterwork-stats')
+    mods_div = soup.find('div', id='mod-stats')
+    weapon_details = {'weaponHash': weapon_id, 'sockets_details': [], 'masterworks': [], 'mods': []}
+
+    all_perk_names = []
+
+    if community_average_div:
+        containers = community_average_div.find_all('ul', class_='list-unstyled sockets')
+        for container in containers:
+            socket_details = []
+            list_items = container.find_all('li')
+            for item in list_items:
+                percent_div = item.find('div', class_='percent')
+                percentage = percent_div.text.strip() if percent_div else None
+
+                image = item.find('img')
+                alt_text = image.get('alt') if image else None
+                
+                if alt_text: all_perk_names.append(alt_text)
+
+                item_detail = {
+                    'percentage': percentage,
+                    'name': alt_text,
+                }
+                socket_details.append(item_detail)
+            
+            if socket_details:
+                weapon_details['sockets_details'].append(socket_details)
+                
+    if masterwork_div:
+        masterwork_blocks = masterwork_div.find_all('div', class_='clearfix')
+        for block in masterwork_blocks:
+            perk_container = block.find('div', class_='perk-container')
+            if perk_container:
+                item = perk_container.find('div', class_='item')
+                if item:
+                    data_id = item.get('data-id')
+                    img_tag = item.find('img')
+                    image_url = img_tag.get('src') if img_tag else None
+                    alt_text = img_tag.get('alt') if img_tag else None
+
+                    # Getting percentage
+                    percent_div = block.find('div', class_='combo-percent')
+                    percentage = percent_div.text.strip() if percent_div else None
+
+                    masterwork_details = {
+                        'id': data_id,
+                        'name': alt_text,
+                        'image_url': image_url,
+                        'percentage': percentage
+                    }
+                    weapon_details['masterworks'].append(masterwork_details)
+                    
+    if mods_div:
+        mod_blocks = mods_div.find_all('div', class_='clearfix')
+        for block in mod_blocks:
+            perk_container = block.find('div', class_='perk-container')
+            if perk_container:
+                item = perk_container.find('div', class_='item')
+                if item:
+                    data_id = item.get('data-id')
+                    img_tag = item.find('img')
+                    image_url = img_tag.get('src') if img_tag else None
+                    alt_text = img_tag.get('alt') if img_tag else None
+
+                    # Getting percentage
+                    percent_div = block.find('div', class_='combo-percent')
+                    percentage = percent_div.text.strip() if percent_div else None
+
+                    mod_details = {
+                        'id': data_id,
+                        'name': alt_text,
+                        'image_url': image_url,
+                        'percentage': percentage
+                    }
+                    weapon_details['mods'].append(mod_details)
+
+    return (weapon_details, all_perk_names)
+
+
+def parse_weapon_page(html, weapon_id, strained=True):
+    try:
+        # The strainer builds only the three sections instead of a tree for the whole page
+        soup = BeautifulSoup(html, 'html.parser', parse_only=SECTION_STRAINER if strained else None)
+        return extract_weapon_details(soup, weapon_id)
+    except Exception as e:
+        print(f"ScrapingLOG: Error parsing details for weapon {weapon_id}: {e}")
+        return None, []
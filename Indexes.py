@@ -0,0 +1,134 @@
+import argparse
+import logging
+import os
+import sys
+from datetime import datetime, timezone
+from pymongo import ASCENDING, DESCENDING, IndexModel, MongoClient
+from pymongo.errors import OperationFailure
+from ScanScheduler import due_users_query
+
+DB_NAME = 'RollRadar'  # MongoDB database name
+ENSURE_INDEXES_ON_STARTUP = os.environ.get('ENSURE_INDEXES_ON_STARTUP', 'true').lower() == 'true'
+
+# Every index the functions rely on, by collection. create_indexes is a no-op for indexes that already exist.
+INDEXES = {
+    'UserDetails': [
+        IndexModel([('bungie_id', ASCENDING)], name='bungie_id'),
+        IndexModel([('next_check_at', ASCENDING)], name='next_check_at'),
+        IndexModel([('expires_at', ASCENDING)], name='expires_at'),
+    ],
+    'UserInstanceList': [IndexModel([('bungieID', ASCENDING)], name='bungieID')],
+    'UserInventory': [IndexModel([('bungie_id', ASCENDING)], name='bungie_id')],
+    'UserWeapons': [
+        IndexModel([('bungie_id', ASCENDING), ('itemId', ASCENDING)], name='bungie_id_itemId', unique=True),
+        IndexModel([('bungie_id', ASCENDING), ('score_float', DESCENDING), ('itemId', ASCENDING)], name='bungie_id_score'),
+        IndexModel([('bungie_id', ASCENDING), ('weaponType', ASCENDING), ('score_float', DESCENDING), ('itemId', ASCENDING)], name='bungie_id_type_score'),
+        IndexModel([('bungie_id', ASCENDING), ('characterId', ASCENDING), ('score_float', DESCENDING), ('itemId', ASCENDING)], name='bungie_id_character_score'),
+        IndexModel([('bungie_id', ASCENDING), ('weaponName', ASCENDING)], name='bungie_id_name'),
+    ],
+    'UserLatestWeapons': [IndexModel([('bungieID', ASCENDING)], name='bungieID')],
+    'UserCharacterDetails': [IndexModel([('bungieID', ASCENDING)], name='bungieID')],
+    'GodRolls': [IndexModel([('weaponHash', ASCENDING)], name='weaponHash')],
+    'WeaponDetails': [
+        IndexModel([('id', ASCENDING)], name='id'),
+        IndexModel([('randomRoll', ASCENDING)], name='randomRoll'),
+    ],
+    'PerkDetails': [
+        IndexModel([('hash', ASCENDING)], name='hash'),
+        IndexModel([('displayProperties.name', ASCENDING), ('inventory.tierType', ASCENDING)], name='name_tierType'),
+    ],
+}
+
+
+def query_shapes():
+    # (collection, filter) for every filtered query the modules issue. Full collection reads are left out on purpose.
+    now = datetime.now(timezone.utc)
+    return [
+        ('UserDetails', {'bungie_id': ''}),
+        ('UserDetails', due_users_query()),
+        ('UserDetails', {'$or': [{'expires_at': {'$lte': now}}, {'expires_at': {'$exists': False}}],
+                         'refresh_expires_at': {'$not': {'$lte': now}}}),
+        ('UserInstanceList', {'bungieID': ''}),
+        ('UserInventory', {'bungie_id': ''}),
+        ('UserWeapons', {'bungie_id': ''}),
+        ('UserWeapons', {'bungie_id': '', 'itemId': {'$in': ['']}}),
+        ('UserWeapons', {'bungie_id': '', '$or': [{'score_float': {'$lt': 1}}, {'score_float': 1, 'itemId': {'$gt': ''}}]}),
+        ('UserWeapons', {'bungie_id': '', 'score_float': {'$gte': 0.5}}),
+        ('UserWeapons', {'bungie_id': '', 'weaponType': ''}),
+        ('UserWeapons', {'bungie_id': '', 'characterId': ''}),
+        ('UserWeapons', {'bungie_id': '', 'weaponName': {'$regex': '^A'}}),
+        ('UserLatestWeapons', {'bungieID': ''}),
+        ('UserCharacterDetails', {'bungieID': ''}),
+        ('GodRolls', {'weaponHash': 0}),
+        ('WeaponDetails', {'id': 0}),
+        ('WeaponDetails', {'id': {'$in': [0]}}),
+        ('WeaponDetails', {'randomRoll': True}),
+        ('PerkDetails', {'hash': {'$in': [0]}}),
+        ('PerkDetails', {'displayProperties.name': {'$in': ['']}, 'inventory.tierType': 2}),
+    ]
+
+
+def ensure_indexes(db):
+    failed = []
+    for collection_name, indexes in INDEXES.items():
+        try:
+            created = db[collection_name].create_indexes(indexes)
+        except OperationFailure as e:
+            # e.g. the same keys already indexed under another name, which shouldn't leave later collections unindexed
+            failed.append(collection_name)
+            logging.error(f"Failed to create indexes on {collection_name}: {e}")
+            continue
+        logging.info(f"Indexes on {collection_name}: {', '.join(created)}")
+    if failed:
+        raise RuntimeError(f"Failed to create indexes on {', '.join(failed)}")
+
+
+def plan_stages(plan):
+    # Walk a query plan and yield the stage of every node
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_stages(value)
+
+
+def check_query_plans(db):
+    failures = []
+    for collection_name, query in query_shapes():
+        winning_plan = db[collection_name].find(query).explain()['queryPlanner']['winningPlan']
+        if 'COLLSCAN' in plan_stages(winning_plan):
+            failures.append((collection_name, query))
+            logging.error(f"Query on {collection_name} does a collection scan: {query}")
+    if failures:
+        raise RuntimeError(f"{len(failures)} query shapes do collection scans")
+    logging.info(f"All {len(query_shapes())} query shapes use an index")
+
+
+def ensure_indexes_on_startup(db):
+    if not ENSURE_INDEXES_ON_STARTUP:
+        return
+    try:
+        ensure_indexes(db)
+    except Exception as e:
+        # Missing indexes only slow queries down, so don't stop the app from starting
+        logging.error(f"Failed to ensure indexes: {e}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Create and verify the RollRadar MongoDB indexes')
+    parser.add_argument('command', choices=['ensure', 'check', 'all'])
+    args = parser.parse_args()
+
+    db = MongoClient(os.environ['MONGODB_URI'])[DB_NAME]
+    try:
+        if args.command in ('ensure', 'all'):
+            ensure_indexes(db)
+        if args.command in ('check', 'all'):
+            check_query_plans(db)
+    except RuntimeError as e:
+        logging.error(e)
+        sys.exit(1)
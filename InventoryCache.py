@@ -0,0 +1,51 @@
+import hashlib
+import os
+from datetime import datetime, timedelta
+from UserWeapons import INVENTORY_STORAGE_MODE, USER_WEAPONS_COLLECTION, WEAPON_SORT
+from MongoSync import CONTENT_HASH_FIELD
+
+INVENTORY_STALE_AFTER = int(os.environ.get('INVENTORY_STALE_AFTER', 3600))  # Seconds before a stored inventory is refreshed in the background
+INVENTORY_REFRESH_COOLDOWN = int(os.environ.get('INVENTORY_REFRESH_COOLDOWN', 300))  # Seconds between background refreshes for one user
+INVENTORY_REFRESH_QUEUE = 'dailyinvusers'  # Read by DailyInvCheck, which runs a full inventory scan
+
+
+def load_stored_inventory(db, bungie_id):
+    inventory = db['UserInventory'].find_one({'bungie_id': bungie_id}, {'_id': 0, 'refresh_requested_at': 0})
+    if inventory is None or INVENTORY_STORAGE_MODE != 'weapons' or 'weapons' in inventory:
+        # A document written before the switch to UserWeapons keeps its weapons until the next full scan replaces it with a header
+        return inventory
+
+    # Only the scan header is kept in UserInventory, the weapons are one document each
+    weapons = db[USER_WEAPONS_COLLECTION].find({'bungie_id': bungie_id}, {'_id': 0, CONTENT_HASH_FIELD: 0, 'bungie_id': 0, 'destiny_id': 0})
+    inventory['weapons'] = list(weapons.sort(WEAPON_SORT))
+    return inventory
+
+
+def inventory_etag(inventory):
+    # Full scans set timestamp, scans that only add new weapons set updated_at. Mongo keeps milliseconds,
+    # so truncate to match whether the inventory was just scanned or read back.
+    changed_at = inventory.get('updated_at') or inventory['timestamp']
+    version = f"{inventory['bungie_id']}:{changed_at.replace(microsecond=changed_at.microsecond // 1000 * 1000).isoformat()}"
+    return f'"{hashlib.sha1(version.encode("utf-8")).hexdigest()[:16]}"'
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in (tag[2:] if tag.startswith('W/') else tag for tag in tags)
+
+
+def is_stale(inventory, now=None):
+    now = now or datetime.now()
+    return now - inventory['timestamp'] > timedelta(seconds=INVENTORY_STALE_AFTER)
+
+
+def claim_refresh(db, bungie_id, now=None):
+    # Atomically record a refresh request, so concurrent app opens enqueue at most one refresh per cooldown
+    now = now or datetime.now()
+    result = db['UserInventory'].update_one(
+        {'bungie_id': bungie_id, '$or': [{'refresh_requested_at': {'$exists': False}},
+                                         {'refresh_requested_at': {'$lte': now - timedelta(seconds=INVENTORY_REFRESH_COOLDOWN)}}]},
+        {'$set': {'refresh_requested_at': now}})
+    return result.modified_count == 1
@@ -1,77 +1,140 @@
-import aiohttp
 import asyncio
 import traceback
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed  # Import for parallel execution
 import logging
 import os
+from GodRollIndex import get_godroll_index, process_weapon
+from BatchAppraiser import appraise_batch
+from WeaponDetailsCache import get_weapon_details
+from BungieClient import BungieApiError, get_bungie_client
+from AdaptiveConcurrency import AdaptiveLimiter
+from UserWeapons import INVENTORY_STORAGE_MODE, sync_user_weapons
+from CompactWeapon import WEAPON_RECORD_FORMAT, CompactWeapon, to_documents
+from pymongo.errors import PyMongoError
 
 # Replace these variables with your actual values
 
 api_key = os.environ["API_KEY"]
 
-async def get_weapon_perks(item_instance_id, destiny_membership_type, destiny_membership_id, session):
-    item_details_url = f"https://www.bungie.net/Platform/Destiny2/{destiny_membership_type}/Profile/{destiny_membership_id}/Item/{item_instance_id}/?components=300,302,304,305,307"
-    async with session.get(item_details_url) as response:
-        if response.status == 200:
-            return await response.json()
-        else:
-            print(f"Failed to fetch item details for instance {item_instance_id}. Status code: {response.status}")
-            return None
-    
-def load_weapon_names(db):
+ITEM_FETCH_INITIAL_CONCURRENCY = int(os.environ.get('ITEM_FETCH_INITIAL_CONCURRENCY', 16))
+ITEM_FETCH_MIN_CONCURRENCY = int(os.environ.get('ITEM_FETCH_MIN_CONCURRENCY', 2))
+ITEM_FETCH_MAX_CONCURRENCY = int(os.environ.get('ITEM_FETCH_MAX_CONCURRENCY', 64))
+ITEM_FETCH_LATENCY_TARGET = float(os.environ.get('ITEM_FETCH_LATENCY_TARGET', 2.0))  # Seconds before a request counts as slow
 
-    collection = db['WeaponDetails']
+BULK_PROFILE_FETCH = os.environ.get('BULK_PROFILE_FETCH', 'true').lower() == 'true'  # Read item details from the profile call instead of one call per item
+PROFILE_COMPONENTS = '200,102'  # Characters, vault
+BULK_PROFILE_COMPONENTS = '102,200,201,205,300,302,304,305,307'  # Also character inventories, equipment and every item's instance components
+SCAN_PROFILE_COMPONENTS = '102,200,201,205'  # Every instance ID without their components, enough for the scanner to find new items
 
-    data = collection.find()
+# Shared by every scan on this worker so the learned window carries over between invocations
+item_fetch_limiter = AdaptiveLimiter('item-details', ITEM_FETCH_INITIAL_CONCURRENCY, ITEM_FETCH_MIN_CONCURRENCY,
+                                     ITEM_FETCH_MAX_CONCURRENCY, ITEM_FETCH_LATENCY_TARGET)
 
-    weapon_names_by_id = {weapon['id']: {'name': weapon['name'], 'tierTypeName': weapon['rarity'], 'icon': weapon['iconPath']} for weapon in data}
-
-    return weapon_names_by_id
+async def get_weapon_perks(item_instance_id, destiny_membership_type, destiny_membership_id, bungie, limiter=None):
+    item_details_path = f"/Destiny2/{destiny_membership_type}/Profile/{destiny_membership_id}/Item/{item_instance_id}/?components=300,302,304,305,307"
+    try:
+        if limiter:
+            return await limiter.run(bungie.get, item_details_path)
+        return await bungie.get(item_details_path)
+    except BungieApiError as e:
+        print(f"Failed to fetch item details for instance {item_instance_id}: {e}")
+        return None
+    
+def load_weapon_names(db):
+    return get_weapon_details(db)
 
-async def fetch_weapon_perks_concurrently(all_weapons, destiny_membership_type, destiny_membership_id, session):
+async def fetch_weapon_perks_concurrently(all_weapons, destiny_membership_type, destiny_membership_id, bungie):
     user_inventory = {}
-    tasks = [get_weapon_perks(weapon['itemInstanceId'], destiny_membership_type, destiny_membership_id, session) for weapon in all_weapons]
+    # The shared limiter adapts how many item requests run at once to Bungie's latency and throttling
+    tasks = [get_weapon_perks(weapon['itemInstanceId'], destiny_membership_type, destiny_membership_id, bungie, item_fetch_limiter) for weapon in all_weapons]
     results = await asyncio.gather(*tasks)
+    logging.info(f"Item detail fetch concurrency: {item_fetch_limiter.metrics()}")
     for result, weapon in zip(results, all_weapons):
         if result:
             user_inventory[weapon['itemInstanceId']] = result
     return user_inventory
 
-async def fetch_profile_data(destiny_membership_id, destiny_membership_type, session):
-    profile_url = f"https://www.bungie.net/Platform/Destiny2/{destiny_membership_type}/Profile/{destiny_membership_id}/?components=200,102"
-    async with session.get(profile_url) as response:
-        if response.status == 200:
-            print(f"Successfully fetched profile data for Destiny ID: {destiny_membership_id}")
-            return await response.json()
-        
-        else:
-            raise Exception("Failed to fetch profile data")
+async def fetch_profile_data(destiny_membership_id, destiny_membership_type, bungie, components=None):
+    if components is None:
+        components = BULK_PROFILE_COMPONENTS if BULK_PROFILE_FETCH else PROFILE_COMPONENTS
+    profile_path = f"/Destiny2/{destiny_membership_type}/Profile/{destiny_membership_id}/?components={components}"
+    # Failures raise a BungieApiError describing why the profile could not be fetched
+    profile_data = await bungie.get(profile_path)
+    print(f"Successfully fetched profile data for Destiny ID: {destiny_membership_id}")
+    return profile_data
+
+
+async def process_weapons_from_data(profile_data, destiny_membership_type, destiny_membership_id, bungie, bungieId, db):
+    character_details = profile_data['Response']['characters']['data']
 
+    all_weapons = await fetch_character_items(profile_data, destiny_membership_type, destiny_membership_id, bungie)
+
+    async_store_character_details(character_details, bungieId, db)
+
+    return all_weapons
+
+def has_character_items(profile_data):
+    response = profile_data.get('Response', {})
+    return 'characterInventories' in response and 'characterEquipment' in response
+
+def has_item_components(profile_data):
+    # Only a bulk profile response carries every item's instance components
+    return has_character_items(profile_data) and 'itemComponents' in profile_data['Response']
+
+def profile_items(profile_data):
+    # Yield (characterId, item) in the same order as the per-character calls: equipment, inventory, then the vault
+    response = profile_data['Response']
+    for character_id in response['characters']['data'].keys():
+        for key in ('characterEquipment', 'characterInventories'):
+            for item in response[key].get('data', {}).get(character_id, {}).get('items', []):
+                yield character_id, item
+    for item in response['profileInventory']['data']['items']:
+        yield None, item
+
+def build_item_responses(profile_data, instance_ids=None):
+    # Rebuild the per-item endpoint's response for each instanced item from one bulk profile response
+    item_components = profile_data['Response']['itemComponents']
+    user_inventory = {}
+    for character_id, item in profile_items(profile_data):
+        item_instance_id = item.get('itemInstanceId')
+        if item_instance_id is None or (instance_ids is not None and item_instance_id not in instance_ids):
+            continue
+
+        response = {'item': {'data': item}}
+        if character_id is not None:
+            response['characterId'] = character_id
+        for key, component in (('instance', 'instances'), ('sockets', 'sockets'), ('stats', 'stats'), ('perks', 'perks')):
+            data = item_components.get(component, {}).get('data', {})
+            # Leave out components Bungie didn't return so extraction skips the item, as it would for a failed item call
+            response[key] = {'data': data[item_instance_id]} if item_instance_id in data else {}
+        user_inventory[item_instance_id] = {'Response': response}
+    return user_inventory
+
+async def fetch_character_items(profile_data, destiny_membership_type, destiny_membership_id, bungie):
+    if has_character_items(profile_data):
+        # Character inventories and equipment are already in the profile response
+        return [{'itemHash': item['itemHash'], 'itemInstanceId': item['itemInstanceId']}
+                for _, item in profile_items(profile_data) if 'itemInstanceId' in item]
 
-async def process_weapons_from_data(profile_data, destiny_membership_type, destiny_membership_id, session, bungieId, db):
     character_ids = profile_data['Response']['characters']['data'].keys()
     vault_items = profile_data['Response']['profileInventory']['data']['items']
 
     all_weapons = []  # Store tuples or dictionaries of weapon hashes and instance IDs
-    character_details = profile_data['Response']['characters']['data']
 
-    async def fetch_items(url):
-        async with session.get(url) as response:
-            if response.status == 200:
-                data = await response.json()
-                return data
-            else:
-                print(f"Failed to fetch data from {url}. Status code: {response.status}")
-                return None
+    async def fetch_items(path):
+        try:
+            return await bungie.get(path)
+        except BungieApiError as e:
+            print(f"Failed to fetch data from {path}: {e}")
+            return None
 
     # Fetch items for each character and the vault asynchronously
     tasks = []
     for character_id in character_ids:
-        equipment_url = f"https://www.bungie.net/Platform/Destiny2/{destiny_membership_type}/Profile/{destiny_membership_id}/Character/{character_id}/?components=205"
-        inventory_url = f"https://www.bungie.net/Platform/Destiny2/{destiny_membership_type}/Profile/{destiny_membership_id}/Character/{character_id}/?components=201"
-        tasks.append(fetch_items(equipment_url))
-        tasks.append(fetch_items(inventory_url))
+        equipment_path = f"/Destiny2/{destiny_membership_type}/Profile/{destiny_membership_id}/Character/{character_id}/?components=205"
+        inventory_path = f"/Destiny2/{destiny_membership_type}/Profile/{destiny_membership_id}/Character/{character_id}/?components=201"
+        tasks.append(fetch_items(equipment_path))
+        tasks.append(fetch_items(inventory_path))
 
     responses = await asyncio.gather(*tasks)
 
@@ -90,8 +153,6 @@ async def process_weapons_from_data(profile_data, destiny_membership_type, desti
         if item_instance_id != 'N/A':
             all_weapons.append({'itemHash': item['itemHash'], 'itemInstanceId': item_instance_id})
 
-    async_store_character_details(character_details, bungieId, db)
-
     return all_weapons
 
 async def async_store_character_details(character_details, bungieID, db):
@@ -149,20 +210,24 @@ def store_character_details(character_details, bungieID, db):
     
     print(f"Successfully updated character document for bungieID: {bungieID}")
 
-async def fetch_and_save_weapon_data(bungieId, membershipType, destiny_membership_id,session, db):
+async def fetch_and_save_weapon_data(bungieId, membershipType, destiny_membership_id,bungie, db):
     try:
-        profile_data = await fetch_profile_data(destiny_membership_id, membershipType, session)
+        profile_data = await fetch_profile_data(destiny_membership_id, membershipType, bungie)
         if profile_data is None:
             print(f"Failed to fetch profile data for Bungie ID {bungieId}. Skipping...")
         else:
             print(f"Successfully fetched profile data for Bungie ID {bungieId}")
         
-        all_weapons = await process_weapons_from_data(profile_data, membershipType, destiny_membership_id, session, bungieId, db)
+        all_weapons = await process_weapons_from_data(profile_data, membershipType, destiny_membership_id, bungie, bungieId, db)
         
-        # Assuming export_list_to_mongodb is updated to async or handled properly if it's synchronous
-        export_list_to_mongodb(all_weapons, bungieId, destiny_membership_id, db)
+        # pymongo blocks, so write from a thread rather than stall the worker's event loop
+        await asyncio.get_running_loop().run_in_executor(None, export_list_to_mongodb, all_weapons, bungieId, destiny_membership_id, db)
 
-        user_inventory = await fetch_weapon_perks_concurrently(all_weapons, membershipType, destiny_membership_id, session)
+        if has_item_components(profile_data):
+            user_inventory = build_item_responses(profile_data)
+        else:
+            # Fall back to one item call per instance when the bulk components are off or missing
+            user_inventory = await fetch_weapon_perks_concurrently(all_weapons, membershipType, destiny_membership_id, bungie)
 
         if user_inventory is None:
             print(f"Failed to fetch weapon perks for Bungie ID {bungieId}. Skipping...")
@@ -200,13 +265,16 @@ def extract_item_details(user_inventory, weapon_details, db):
             # Lookup weapon name and tierTypeName using item_hash
             weapon_info = weapon_details.get(item_hash, None)
             
-            if weapon_info:
+            if weapon_info and WEAPON_RECORD_FORMAT == 'compact':
+                extracted_details.append(CompactWeapon.from_components(item_details, sockets_details, instance_details, stats_details, weapon_info, characterID))
+            elif weapon_info:
                 extracted_details.append({
                     'itemId': iteminstanceid,
                     'weaponHash': item_hash,
                     'characterId': characterID,
                     'weaponName': weapon_info.get('name', 'N/A'),  # Provide 'N/A' as default value
                     'icon': weapon_info.get('icon', 'N/A'),  # Provide 'N/A' as default value
+                    'weaponType': weapon_info.get('type'),
                     'instance': instance_details if instance_details else 'N/A',  # Provide 'N/A' as default value
                     'socketHashes': sockets if sockets else [],  # Provide empty list as default value
                     'socketsDetails': sockets_details if sockets_details else [],  # Provide empty list as default value
@@ -222,75 +290,37 @@ def extract_item_details(user_inventory, weapon_details, db):
     return extracted_details
 
 
-def process_weapon(invweapon, godrolls):
-    weaponHash = int(invweapon['weaponHash'])
-    invweapon['score'] = '0/4'  # Initialize the match score out of 4
-    total_percentage = 0  # Initialize the total percentage score
+def appraise_inv_parallel(inv, bungieID, destiny_id, db, godroll_index=None):
+    if godroll_index is None:
+        godroll_index = get_godroll_index(db)
 
-    # Find the god roll document that matches the weapon's hash
-    for godroll in godrolls.find({'weaponHash': weaponHash}):
-        match_count = 0  # Initialize match count for this god roll
-        total_weighted_percentage = 0  # Initialize total weighted percentage score
-        
-        # Iterate through the first 4 socket groups of the god roll
-        for socket_group in godroll['sockets_details'][:4]:
-            group_weighted_percentage = 0  # Initialize weighted percentage for the current group
-            
-            for index, socket_option in enumerate(socket_group):
-                # Calculate the weight for the current socket based on its position
-                weight = 100 - (index * 25)
-                weight = max(weight, 0)  # Ensure the weight is not negative
-                
-                # Extract the socket hash safely
-                socket_hash = None
-                if 'socketHash' in socket_option:
-                    if isinstance(socket_option['socketHash'], dict):
-                        socket_hash_key = '$numberLong' if '$numberLong' in socket_option['socketHash'] else '$numberInt'
-                        socket_hash = int(socket_option['socketHash'][socket_hash_key])
-                    elif isinstance(socket_option['socketHash'], int):
-                        socket_hash = socket_option['socketHash']
-                
-                if socket_hash is not None and socket_hash in invweapon['socketHashes']:
-                    match_count += 1 if index == 0 else 0  # Increment match count only for the first option
-                    group_weighted_percentage = max(group_weighted_percentage, weight)  # Take the highest weight for this group
-            
-            total_weighted_percentage += group_weighted_percentage  # Add the group's weight to the total
-        
-        # Normalize total_weighted_percentage to a scale of 0-100
-        total_percentage = (total_weighted_percentage / 400) * 100
-        invweapon['score'] = f"{match_count}/4"
-        break  # Assuming we only process the first matching god roll
-
-    invweapon['total_percentage'] = total_percentage
-    return invweapon
-
-
-def appraise_inv_parallel(inv, bungieID, destiny_id, db):
-    godrolls = db["GodRolls"]
-
-    # Use ThreadPoolExecutor to process each weapon in parallel
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        # Prepare future tasks
-        futures = [executor.submit(process_weapon, invweapon, godrolls) for invweapon in inv]
-
-        # Process as each future completes
-        for future in as_completed(futures):
-            result = future.result()
-            if result:
-                score = result.get('score')
-                if score:
-                    x, y = map(int, score.split('/'))
-                    result['score_float'] = x / y if y != 0 else 0
-                else:
-                    result['score_float'] = 0  # Default score for weapons without a score
+    # Scoring is an in-memory lookup against the god roll index, so no worker pool is needed
+    for invweapon in inv:
+        result = process_weapon(invweapon, godroll_index)
+        if result:
+            score = result.get('score')
+            if score:
+                x, y = map(int, score.split('/'))
+                result['score_float'] = x / y if y != 0 else 0
+            else:
+                result['score_float'] = 0  # Default score for weapons without a score
+
+    return complete_inventory(inv, bungieID, destiny_id)
+
+def appraise_inv_batch(inv, bungieID, destiny_id, db, godroll_index=None):
+    if godroll_index is None:
+        godroll_index = get_godroll_index(db)
+
+    # Score the whole inventory in one vectorised pass
+    appraise_batch(inv, godroll_index)
+
+    return complete_inventory(inv, bungieID, destiny_id)
 
+def complete_inventory(inv, bungieID, destiny_id):
     inv.sort(key=lambda x: x['score_float'], reverse=True)
 
-    # Process inv as needed
     print(f"Found {len(inv)} weapons with matching sockets. Scores are based on the fraction of matches.")
-    for weapon in inv:
-        score = weapon.get('score', 'No score')  # Default text for weapons without a score
-        
+
     completedinv ={
         'bungie_id': bungieID,
         'destiny_id': destiny_id,
@@ -321,22 +351,41 @@ def export_list_to_mongodb(all_weapons, bungieID, destiny_membership_id, db):
 
 def export_to_mongodb(details, bungieID, db):
     
+    if INVENTORY_STORAGE_MODE in ('weapons', 'both'):
+        # One document per weapon, only the weapons that changed since the last scan are written
+        try:
+            sync_user_weapons(db, details)
+        except PyMongoError as e:
+            # The inventory document is still written, the next scan syncs the weapons again
+            print(f"Failed to sync weapons to MongoDB for bungieID: {bungieID}. Error: {e}")
+
     collection = db["UserInventory"]
-            
-    collection.replace_one({'bungie_id': bungieID}, details, upsert=True)
+    if INVENTORY_STORAGE_MODE in ('document', 'both'):
+        collection.replace_one({'bungie_id': bungieID}, details, upsert=True)
+    else:
+        # Keep just the scan header so readers can tell how fresh the weapons are
+        header = {key: value for key, value in details.items() if key != 'weapons'}
+        collection.replace_one({'bungie_id': bungieID}, header, upsert=True)
     
-    print(f"Inserted {len(details)} weapons into MongoDB.")
+    print(f"Inserted {len(details['weapons'])} weapons into MongoDB.")
 
-async def process_user_inventory(bungieID, membershipType, destiny_membership_id,weapon_details, db, session):
+async def process_user_inventory(bungieID, membershipType, destiny_membership_id,weapon_details, db, bungie):
     print(f"Fetching inventory for Bungie ID {bungieID}")
-    user_inventory = await fetch_and_save_weapon_data(bungieID, membershipType, destiny_membership_id,session, db)
+    user_inventory = await fetch_and_save_weapon_data(bungieID, membershipType, destiny_membership_id,bungie, db)
 
     if user_inventory is None:
         print(f"Failed to fetch inventory for Bungie ID {bungieID}. Skipping...")
         return  # Early return if user_inventory is None
     
-    sanitised_inventory = extract_item_details(user_inventory, weapon_details, db)
-    appraised_inventory = appraise_inv_parallel(sanitised_inventory, bungieID, destiny_membership_id, db)
+    # Extraction, appraisal and the Mongo writes block, so they run on threads and the event loop stays free for other invocations
+    loop = asyncio.get_running_loop()
+    sanitised_inventory = await loop.run_in_executor(None, extract_item_details, user_inventory, weapon_details, db)
+    del user_inventory  # Compact records don't reference the raw responses, so they can be freed before appraisal
+    return await loop.run_in_executor(None, appraise_and_export, sanitised_inventory, bungieID, destiny_membership_id, db)
+
+def appraise_and_export(sanitised_inventory, bungieID, destiny_membership_id, db):
+    appraised_inventory = appraise_inv_batch(sanitised_inventory, bungieID, destiny_membership_id, db)
+    appraised_inventory['weapons'] = to_documents(appraised_inventory['weapons'])
     export_to_mongodb(appraised_inventory, bungieID, db)
     
     return appraised_inventory
@@ -350,22 +399,18 @@ async def GetInventory(db, bungieID, membershipType, destiny_membership_id,acces
     print("Membership Type: ", membershipType)
     print("Destiny Membership ID: ", destiny_membership_id)
     
-    async with aiohttp.ClientSession(headers={
-        'X-API-Key': api_key,
-        'Authorization': f'Bearer {access_token}'
-    }) as session:
-
-        # Load weapon names into memory
-        weapon_details = load_weapon_names(db)
-
-        # Process the inventory for the single user
-        try:
-            appraised_inv = await process_user_inventory(bungieID, membershipType, destiny_membership_id,weapon_details, db, session)
-            print(f"Successfully processed inventory for Bungie ID {bungieID}")
-            return appraised_inv
-        except Exception as exc:
-            tb_str = traceback.format_exception(type(exc), exc, exc.__traceback__)
-            tb_str = "".join(tb_str)  # Convert list of strings into a single string
-            logging.error(f"An error occurred while processing inventory for Bungie ID {bungieID}:\n{tb_str}")
+    # Shared, connection-pooled Bungie client carrying this user's token
+    bungie = get_bungie_client(api_key).for_user(access_token)
 
+    # Load weapon names into memory, off the event loop since a cache miss reads Mongo
+    weapon_details = await asyncio.get_running_loop().run_in_executor(None, load_weapon_names, db)
 
+    # Process the inventory for the single user
+    try:
+        appraised_inv = await process_user_inventory(bungieID, membershipType, destiny_membership_id,weapon_details, db, bungie)
+        print(f"Successfully processed inventory for Bungie ID {bungieID}")
+        return appraised_inv
+    except Exception as exc:
+        tb_str = traceback.format_exception(type(exc), exc, exc.__traceback__)
+        tb_str = "".join(tb_str)  # Convert list of strings into a single string
+        logging.error(f"An error occurred while processing inventory for Bungie ID {bungieID}:\n{tb_str}")
\ No newline at end of file
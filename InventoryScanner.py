@@ -1,9 +1,17 @@
 import logging
-import requests
+import asyncio
 from pymongo import MongoClient
 from pyfcm import FCMNotification
 import os
 from datetime import datetime
+from GodRollIndex import get_godroll_index, process_weapon
+from WeaponDetailsCache import get_weapon_details
+from InventoryReader import SCAN_PROFILE_COMPONENTS, fetch_profile_data, fetch_character_items, get_weapon_perks, item_fetch_limiter, has_item_components, build_item_responses
+from BungieClient import get_bungie_client
+from ScanScheduler import schedule_next_check
+from UserWeapons import INVENTORY_STORAGE_MODE, upsert_user_weapons
+from CompactWeapon import WEAPON_RECORD_FORMAT, CompactWeapon, to_documents
+from ScanProbe import SCAN_PROBE_ENABLED, PROBE_COMPONENTS, probe_fingerprint, get_stored_fingerprint, store_fingerprint, record_probe_result
 
 logger = logging.getLogger('azure')
 logger.setLevel(logging.INFO)
@@ -16,76 +24,114 @@ API_KEY = os.environ['API_KEY']  # Bungie API key
 CLIENT_SECRET = os.environ['CLIENT_SECRET']  # Bungie client secret
 CLIENT_ID = os.environ['CLIENT_ID']  # Bungie client ID
 FCM_API_KEY = os.environ['FCM_API_KEY']  # Firebase Cloud Messaging API key
+RECENT_WEAPONS_LIMIT = int(os.environ.get('RECENT_WEAPONS_LIMIT', 50))  # Weapons kept in a user's recent list
 
 client = MongoClient(MONGODB_URI)
 
 db = client['RollRadar']
 
-def ProcessQueueMessage(userDetails):
+async def ProcessQueueMessage(userDetails):
     user_id = userDetails['bungie_id']
     membership_type = userDetails['membership_type']
     access_token = userDetails['access_token']
     destinyID = userDetails['destiny_membership_id']
         
-    headers = {
-            'X-API-Key': API_KEY,
-            'Authorization': f'Bearer {access_token}'
-        }
-        
-    weaponsList = getWeaponsList(user_id)  # This needs to be converted to a synchronous call
-        
-    currentWeaponList = getCurrentWeaponsList(destinyID, membership_type, headers)  # Adapt this function to be synchronous
-        
-        # Log the counts
+    # Shared, connection-pooled Bungie client carrying this user's token
+    bungie = get_bungie_client(API_KEY).for_user(access_token)
+    
+    loop = asyncio.get_running_loop()
+
+    if SCAN_PROBE_ENABLED:
+        # One light profile call tells whether anything can have changed since the last full scan
+        probe_profile, stored_fingerprint = await asyncio.gather(
+            fetch_profile_data(destinyID, membership_type, bungie, PROBE_COMPONENTS),
+            loop.run_in_executor(None, get_stored_fingerprint, db, user_id)
+        )
+        fingerprint = probe_fingerprint(probe_profile)
+        hit = fingerprint == stored_fingerprint
+        await loop.run_in_executor(None, record_probe_result, db, hit)
+        if hit:
+            logging.info(f"Nothing changed for user ID: {user_id}, skipping the full scan")
+            await loop.run_in_executor(None, schedule_next_check, db, user_id, probe_profile, False)
+            return
+
+    await scanInventory(user_id, membership_type, destinyID, bungie, loop)
+
+    if SCAN_PROBE_ENABLED:
+        # Only remember the fingerprint once the scan it describes has been stored
+        await loop.run_in_executor(None, store_fingerprint, db, user_id, fingerprint)
+
+async def scanInventory(user_id, membership_type, destinyID, bungie, loop):
+    # Read the stored instance list while the inventory is fetched
+    weaponsList, (profile_data, currentWeaponList) = await asyncio.gather(
+        loop.run_in_executor(None, getWeaponsList, user_id),
+        getCurrentWeaponsList(destinyID, membership_type, bungie)
+    )
+            
+    # Log the counts
     logger.info(f"User ID: {user_id} has {len(weaponsList)} weapons in the database.")
     logger.info(f"User ID: {user_id} has {len(currentWeaponList)} weapons in the current inventory.")
         
     weaponsListSet = set(weaponsList)
     currentWeaponListSet = set(item['itemInstanceId'] for item in currentWeaponList)
         
-        # Identify new weapons by finding instance IDs in currentWeaponList not in weaponsList
+    # Identify new weapons by finding instance IDs in currentWeaponList not in weaponsList
     new_weapons = currentWeaponListSet - weaponsListSet
-        
+
     if new_weapons:
         logger.info(f"User ID: {user_id} has new weapons: {new_weapons}")
+        final_weapons = await appraise_new_weapons(new_weapons, profile_data, user_id, membership_type, destinyID, bungie, loop)
+    else:
+        logging.info(f"No new weapons found for user ID: {user_id}")
+        final_weapons = []
+
+    # Space the next scan out by how recently the user played. Only appraised weapons count: armor and unknown
+    # items never reach the instance list, so they would look new on every scan.
+    await loop.run_in_executor(None, schedule_next_check, db, user_id, profile_data, bool(final_weapons))
+
+    if not final_weapons:
+        if new_weapons:
+            logging.info(f"No new weapons with known definitions for user ID: {user_id}")
+        return
+    
+    # Write each collection once for the whole scan and send the notifications alongside
+    await asyncio.gather(
+        loop.run_in_executor(None, add_weapons_to_mongodb, final_weapons, user_id, destinyID),
+        loop.run_in_executor(None, add_to_instance_list, final_weapons, user_id),
+        loop.run_in_executor(None, add_to_recent_weapons, final_weapons, user_id),
+        *[loop.run_in_executor(None, send_notification, weapon['weaponName']) for weapon in final_weapons]
+    )
+
+async def appraise_new_weapons(new_weapons, profile_data, user_id, membership_type, destinyID, bungie, loop):
+    if has_item_components(profile_data):
+        # The bulk profile response already holds the details of every new item
+        new_weapon_responses = list(build_item_responses(profile_data, new_weapons).values())
+    else:
+        # Fetch the details of every new item at once
+        responses = await asyncio.gather(*[get_weapon_perks(weapon, membership_type, destinyID, bungie, item_fetch_limiter) for weapon in new_weapons])
+        new_weapon_responses = [response for response in responses if response]
+    
+    new_item_hashes = [weapon['Response']['item']['data']['itemHash'] for weapon in new_weapon_responses]
             
-        new_weapon_responses =[]
-            
-        new_item_hashes = []
-        for weapon in new_weapons:
-            new_weapon_details = get_weapon_details(weapon, membership_type, destinyID, headers)
-            weapon_hash = new_weapon_details['Response']['item']['data']['itemHash']       
-            new_item_hashes.append(weapon_hash)
-            new_weapon_responses.append(new_weapon_details)
-                
-        logging.info(f"New weapon hashes: {new_item_hashes}")
-                
-        weapon_details = load_weapon_names(new_item_hashes)
-            
-        sanitised_weapons = []
-            
-        for weapon in new_weapon_responses:
-            associated_weapon_details = weapon_details.get(weapon['Response']['item']['data']['itemHash'], None)
-            if associated_weapon_details:
-                extracted_details = extract_item_details(weapon, associated_weapon_details)
-                if extracted_details:
-                    sanitised_weapons.append(extracted_details)      
+    logging.info(f"New weapon hashes: {new_item_hashes}")
             
-        final_weapons = []
-        for weapon in sanitised_weapons:
-            completed_weapon = appraise_weapon(weapon, user_id, destinyID)
-            final_weapons.append(completed_weapon)
-            add_to_recent_weapons(completed_weapon, user_id)
-            send_notification(completed_weapon['weaponName'])  
-        add_weapons_to_mongodb(final_weapons, user_id)
-        add_to_instance_list(final_weapons, user_id)          
-    else :
-        logging.info(f"No new weapons found for user ID: {user_id}")
+    weapon_details = await loop.run_in_executor(None, load_weapon_names, new_item_hashes)
+        
+    sanitised_weapons = []
+        
+    for weapon in new_weapon_responses:
+        associated_weapon_details = weapon_details.get(weapon['Response']['item']['data']['itemHash'], None)
+        if associated_weapon_details:
+            extracted_details = extract_item_details(weapon, associated_weapon_details)
+            if extracted_details:
+                sanitised_weapons.append(extracted_details)      
+        
+    final_weapons = to_documents([appraise_weapon(weapon, user_id, destinyID) for weapon in sanitised_weapons])
+    return final_weapons
 
 def getWeaponsList(bungie_id):
     collection = db['UserInstanceList']
     
-    # Await the asynchronous operation to get the result
     user = collection.find_one({'bungieID': bungie_id})
     
     # Now you can safely access `user['weapons']` assuming the user exists and has a 'weapons' field
@@ -95,70 +141,12 @@ def getWeaponsList(bungie_id):
     else:
         return []
     
-def getCurrentWeaponsList(destiny_id, membership_type, headers):
-    profile_data = fetch_profile_data(destiny_id, membership_type, headers)
-    currentWeapons = process_weapons_from_data(profile_data, membership_type, destiny_id, headers)
-    return currentWeapons
+async def getCurrentWeaponsList(destiny_id, membership_type, bungie):
+    # Instance IDs only, the components of the few new items are fetched once they are known
+    profile_data = await fetch_profile_data(destiny_id, membership_type, bungie, SCAN_PROFILE_COMPONENTS)
+    currentWeapons = await fetch_character_items(profile_data, membership_type, destiny_id, bungie)
+    return profile_data, currentWeapons
 
-def fetch_profile_data(destiny_membership_id, destiny_membership_type, headers):
-    profile_url = f"https://www.bungie.net/Platform/Destiny2/{destiny_membership_type}/Profile/{destiny_membership_id}/?components=200,102"
-    response = requests.get(profile_url, headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        raise Exception(f"Failed to fetch profile data with status code: {response.status_code} for user ID: {destiny_membership_id}")
-
-
-def process_weapons_from_data(profile_data, destiny_membership_type, destiny_membership_id, headers):
-    character_ids = profile_data['Response']['characters']['data'].keys()
-    vault_items = profile_data['Response']['profileInventory']['data']['items']
-
-    all_weapons = []  # Store tuples or dictionaries of weapon hashes and instance IDs
-    
-    # Loop through each character ID to fetch both equipped and unequipped items
-    for character_id in character_ids:
-        character_equipment_url = f"https://www.bungie.net/Platform/Destiny2/{destiny_membership_type}/Profile/{destiny_membership_id}/Character/{character_id}/?components=205"
-        character_inventory_url = f"https://www.bungie.net/Platform/Destiny2/{destiny_membership_type}/Profile/{destiny_membership_id}/Character/{character_id}/?components=201"
-        
-        # Fetch equipped items
-        equipment_response = requests.get(character_equipment_url, headers=headers)
-        if equipment_response.status_code == 200:
-            equipped_items = equipment_response.json().get('Response', {}).get('equipment', {}).get('data', {}).get('items', [])
-            for item in equipped_items:
-                item_instance_id = item.get('itemInstanceId', 'N/A')
-                if item_instance_id != 'N/A':
-                    all_weapons.append({'itemHash': item['itemHash'], 'itemInstanceId': item_instance_id})
-        else:
-            print(f"Failed to fetch equipped items for character {character_id}")
-
-        # Fetch unequipped items (inventory)
-        inventory_response = requests.get(character_inventory_url, headers=headers)
-        if inventory_response.status_code == 200:
-            inventory_items = inventory_response.json().get('Response', {}).get('inventory', {}).get('data', {}).get('items', [])
-            for item in inventory_items:
-                item_instance_id = item.get('itemInstanceId', 'N/A')
-                if item_instance_id != 'N/A':
-                    all_weapons.append({'itemHash': item['itemHash'], 'itemInstanceId': item_instance_id})
-        else:
-            print(f"Failed to fetch inventory items for character {character_id}")
-                
-    # Process weapons from the vault
-    for item in vault_items:
-        item_instance_id = item.get('itemInstanceId', 'N/A')
-        if item_instance_id != 'N/A':
-            all_weapons.append({'itemHash': item['itemHash'], 'itemInstanceId': item_instance_id})  
-            
-    return all_weapons
-
-def get_weapon_details(item_instance_id, destiny_membership_type, destiny_membership_id, headers):
-    item_details_url = f"https://www.bungie.net/Platform/Destiny2/{destiny_membership_type}/Profile/{destiny_membership_id}/Item/{item_instance_id}/?components=300,302,304,305,307"
-    response = requests.get(item_details_url, headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        logging.error(f"Failed to fetch item details for instance {item_instance_id}. Status code: {response.status_code}")
-        return None
-    
 def extract_item_details(weapon, weapon_details):
     try:
         item_details = weapon['Response']['item']['data']
@@ -176,6 +164,9 @@ def extract_item_details(weapon, weapon_details):
         # Lookup weapon name and tierTypeName using item_hash
         weapon_info = weapon_details
         
+        if weapon_info and WEAPON_RECORD_FORMAT == 'compact':
+            return CompactWeapon.from_components(item_details, sockets_details, instance_details, stats_details, weapon_info)
+
         # Only include items with a valid weapon name and tierTypeName is Legendary
         if weapon_info:
             extracted_detail = {
@@ -183,6 +174,7 @@ def extract_item_details(weapon, weapon_details):
                 'weaponHash': item_hash,
                 'weaponName': weapon_info.get('name', 'N/A'),  # Provide 'N/A' as default value
                 'icon': weapon_info.get('icon', 'N/A'),  # Provide 'N/A' as default value
+                'weaponType': weapon_info.get('type'),
                 'instance': instance_details if instance_details else 'N/A',  # Provide 'N/A' as default value
                 'socketHashes': sockets if sockets else [],  # Provide empty list as default value
                 'socketsDetails': sockets_details if sockets_details else [],  # Provide empty list as default value
@@ -194,17 +186,16 @@ def extract_item_details(weapon, weapon_details):
         return None
     
 def load_weapon_names(weapon_hashes):
-    collection = db['WeaponDetails']
-    data = collection.find({"id": {"$in": weapon_hashes}})
-    weapon_names_by_id = {weapon['id']: {'name': weapon['name'], 'tierTypeName': weapon['rarity'], 'icon': weapon['iconPath']} for weapon in data}
+    weapon_details = get_weapon_details(db)
+    weapon_names_by_id = {weapon_hash: weapon_details[weapon_hash] for weapon_hash in weapon_hashes if weapon_hash in weapon_details}
     
     return weapon_names_by_id
 
 def appraise_weapon(weapon, bungieID, destiny_id):
-    godrolls = db["GodRolls"]
+    godroll_index = get_godroll_index(db)
 
     # Process the weapon
-    result = process_weapon(weapon, godrolls)
+    result = process_weapon(weapon, godroll_index)
     if result:
         score = result.get('score')
         if score:
@@ -220,96 +211,40 @@ def appraise_weapon(weapon, bungieID, destiny_id):
 
     return completed_weapon
 
-def process_weapon(invweapon, godrolls):
-    weaponHash = int(invweapon['weaponHash'])
-    invweapon['score'] = '0/4'  # Initialize the match score out of 4
-    total_percentage = 0  # Initialize the total percentage score
+def add_weapons_to_mongodb(weapons, bungieID, destinyID):
+    if INVENTORY_STORAGE_MODE in ('weapons', 'both'):
+        upsert_user_weapons(db, bungieID, destinyID, weapons)
 
-    # Find the god roll document that matches the weapon's hash
-    for godroll in godrolls.find({'weaponHash': weaponHash}):
-        match_count = 0  # Initialize match count for this god roll
-        total_weighted_percentage = 0  # Initialize total weighted percentage score
-        
-        # Iterate through the first 4 socket groups of the god roll
-        for socket_group in godroll['sockets_details'][:4]:
-            group_weighted_percentage = 0  # Initialize weighted percentage for the current group
-            
-            for index, socket_option in enumerate(socket_group):
-                # Calculate the weight for the current socket based on its position
-                weight = 100 - (index * 25)
-                weight = max(weight, 0)  # Ensure the weight is not negative
-                
-                # Extract the socket hash safely
-                socket_hash = None
-                if 'socketHash' in socket_option:
-                    if isinstance(socket_option['socketHash'], dict):
-                        socket_hash_key = '$numberLong' if '$numberLong' in socket_option['socketHash'] else '$numberInt'
-                        socket_hash = int(socket_option['socketHash'][socket_hash_key])
-                    elif isinstance(socket_option['socketHash'], int):
-                        socket_hash = socket_option['socketHash']
-                
-                if socket_hash is not None and socket_hash in invweapon['socketHashes']:
-                    match_count += 1 if index == 0 else 0  # Increment match count only for the first option
-                    group_weighted_percentage = max(group_weighted_percentage, weight)  # Take the highest weight for this group
-            
-            total_weighted_percentage += group_weighted_percentage  # Add the group's weight to the total
-        
-        # Normalize total_weighted_percentage to a scale of 0-100
-        total_percentage = (total_weighted_percentage / 400) * 100
-        invweapon['score'] = f"{match_count}/4"
-        break  # Assuming we only process the first matching god roll
-
-    invweapon['total_percentage'] = total_percentage
-    return invweapon
-
-def add_weapons_to_mongodb(weapons, bungieID):
     collection = db['UserInventory']
-    doc = collection.find_one({'bungieID': bungieID})
-    
-    if doc:
-        docweapons = doc.get('weapons', [])
-        docweapons.append(weapons)
-        
-        collection.update_one({'bungieID': bungieID}, {'$set': {'weapons': docweapons}})
+    # updated_at moves the stored inventory's ETag on without marking it as freshly scanned
+    update = {'$set': {'updated_at': datetime.now()}}
+    if INVENTORY_STORAGE_MODE in ('document', 'both'):
+        # Push server side, keeping the stored inventory ordered by score like the full appraisal writes it
+        update['$push'] = {'weapons': {'$each': weapons, '$sort': {'score_float': -1}}}
+    collection.update_one({'bungie_id': bungieID}, update)
     
     logging.info(f"Added weapons to MongoDB for user ID: {bungieID}")
 
 def add_to_instance_list(weapons, bungieID):
     collection = db['UserInstanceList']
     
-    user = collection.find_one({'bungieID': bungieID})
-    
-    newWeapons = user.get('weapons', [])
-        
-    for weapon in weapons:
-        # Extract only itemId and weaponHash from each weapon
-        simplified_weapon = {'itemHash': weapon.get('weaponHash'), 'itemInstanceId': weapon.get('itemId')}
-        newWeapons.append(simplified_weapon)
-        logging.info(f"Added weapon to instance list: {simplified_weapon['itemInstanceId']}")
+    # Extract only itemId and weaponHash from each weapon
+    simplified_weapons = [{'itemHash': weapon.get('weaponHash'), 'itemInstanceId': weapon.get('itemId')} for weapon in weapons]
     
     # Get current time
     current_time = datetime.now()
 
-    # Update weapons and timestamp
-    collection.update_one({'bungieID': bungieID}, {'$set': {'weapons': newWeapons, 'timestamp': current_time}})
+    # Append the new instances and update the timestamp without reading the list back
+    collection.update_one({'bungieID': bungieID}, {'$push': {'weapons': {'$each': simplified_weapons}}, '$set': {'timestamp': current_time}}, upsert=True)
     logging.info(f"Added {len(weapons)} weapons to instance list for user ID: {bungieID}")
     
-def add_to_recent_weapons(weapon, bungieID):
+def add_to_recent_weapons(new_weapons, bungieID):
     collection = db['UserLatestWeapons']
     
-    user = collection.find_one({'bungieID': bungieID})
-    weapons = user.get('weapons', []) if user else []
-    
-    weapons.append(weapon)
-    
-    weapons_schema = {
-        'bungieID': bungieID,
-        'weapons': weapons
-    }
-    
-    collection.replace_one({'bungieID': bungieID}, weapons_schema, upsert=True)
+    # Keep only the newest RECENT_WEAPONS_LIMIT weapons
+    collection.update_one({'bungieID': bungieID}, {'$push': {'weapons': {'$each': new_weapons, '$slice': -RECENT_WEAPONS_LIMIT}}}, upsert=True)
     
-    logging.info(f"Added weapons to recent weapons for user ID: {bungieID}")
+    logging.info(f"Added {len(new_weapons)} weapons to recent weapons for user ID: {bungieID}")
     
     
 def send_notification(weapon_name):
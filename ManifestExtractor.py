@@ -0,0 +1,107 @@
+import sqlite3
+import json
+import logging
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from GetAllWeapons import process_decoded_weapon
+from GetAllPerks import PERK_CATEGORY_HASHES
+
+MANIFEST_EXTRACT_WORKERS = int(os.environ.get('MANIFEST_EXTRACT_WORKERS', 1))  # Processes used to decode item definitions
+
+WEAPON_ITEM_TYPE = 3
+PERK_CATEGORIES = frozenset(PERK_CATEGORY_HASHES)
+
+
+def build_weapon(item):
+    display_properties = item.get('displayProperties') or {}
+    inventory = item.get('inventory') or {}
+    weapon_stats_data = (item.get('stats') or {}).get('stats')
+    if weapon_stats_data is None:
+        print(f"Missing stats for weapon: {display_properties.get('name')}")
+        return None  # Skip weapons whose stats can't be read
+
+    weapon_dict = {
+        "id": item.get('hash'),
+        "name": display_properties.get('name'),
+        "type": item.get('itemTypeDisplayName'),
+        "rarity": inventory.get('tierTypeName'),
+        "damageTypes": None,
+        "stats": None,
+        "ammoType": (item.get('equippingBlock') or {}).get('ammoType'),
+        "weaponSlot": inventory.get('bucketTypeHash'),
+        "acquisitionSource": item.get('displaySource'),
+        "loreHash": item.get('loreHash'),
+        "iconPath": display_properties.get('icon'),
+        "watermarkPath": item.get('iconWatermark'),
+        "screenshotPath": item.get('screenshot'),
+        "socket_types": None,
+        "randomRoll": False
+    }
+
+    return process_decoded_weapon(weapon_dict, weapon_stats_data, item.get('damageTypes') or [], item.get('sockets'))
+
+
+def extract_rows(db_path, first_rowid=None, last_rowid=None):
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    query = "SELECT json FROM DestinyInventoryItemDefinition"
+    params = ()
+    if first_rowid is not None:
+        query += " WHERE rowid BETWEEN ? AND ?"
+        params = (first_rowid, last_rowid)
+    query += " ORDER BY rowid"
+
+    weapons = []
+    perks = []
+    try:
+        for (item_json,) in cursor.execute(query, params):
+            # Decode each definition once and route it by type
+            item = json.loads(item_json)
+
+            if item.get('itemType') == WEAPON_ITEM_TYPE and (item.get('displayProperties') or {}).get('name') is not None:
+                weapon = build_weapon(item)
+                if weapon:
+                    weapons.append(weapon)
+
+            if not PERK_CATEGORIES.isdisjoint(item.get('itemCategoryHashes') or []):
+                perks.append(item)
+    finally:
+        conn.close()
+
+    return weapons, perks
+
+
+def rowid_ranges(db_path, workers):
+    conn = sqlite3.connect(db_path)
+    try:
+        first_rowid, last_rowid = conn.execute("SELECT MIN(rowid), MAX(rowid) FROM DestinyInventoryItemDefinition").fetchone()
+    finally:
+        conn.close()
+
+    if first_rowid is None:
+        return []
+
+    step = (last_rowid - first_rowid) // workers + 1
+    return [(start, min(start + step - 1, last_rowid)) for start in range(first_rowid, last_rowid + 1, step)]
+
+
+def extract_manifest(db_path, workers=MANIFEST_EXTRACT_WORKERS):
+    if workers > 1:
+        ranges = rowid_ranges(db_path, workers)
+        # Spawn rather than fork, forking would copy the Functions worker along with its live gRPC and MongoDB threads
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(extract_rows, db_path, first_rowid, last_rowid) for first_rowid, last_rowid in ranges]
+            results = [future.result() for future in futures]
+    else:
+        results = [extract_rows(db_path)]
+
+    weapons = [weapon for range_weapons, _ in results for weapon in range_weapons]
+    perks = [perk for _, range_perks in results for perk in range_perks]
+
+    # Match the name ordering of the SQL weapon query
+    weapons.sort(key=lambda weapon: weapon['name'])
+
+    logging.info(f"Extracted {len(weapons)} weapons and {len(perks)} perks from the Destiny 2 Manifest using {workers} worker(s)")
+    return weapons, perks
@@ -0,0 +1,54 @@
+import hashlib
+import json
+import logging
+from pymongo import InsertOne, ReplaceOne, DeleteMany
+
+CONTENT_HASH_FIELD = 'contentHash'  # Stored on each synced document so unchanged definitions are skipped
+
+
+def content_hash(document):
+    content = {field: value for field, value in document.items() if field not in ('_id', CONTENT_HASH_FIELD)}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def sync_collection(collection, documents, key, scope=None):
+    # Bring the collection, or the part of it matching scope, in line with documents, writing only what differs from what is stored
+    scope = scope or {}
+    stored_hashes = {doc.get(key): doc.get(CONTENT_HASH_FIELD) for doc in collection.find(scope, {'_id': 0, key: 1, CONTENT_HASH_FIELD: 1})}
+
+    operations = []
+    counts = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+    seen_keys = set()
+    for document in documents:
+        document_key = document.get(key)
+        if document_key in seen_keys:
+            continue  # The first definition for a key wins
+        seen_keys.add(document_key)
+
+        document = dict(document)
+        document[CONTENT_HASH_FIELD] = content_hash(document)
+
+        if document_key not in stored_hashes:
+            if scope:
+                # Another writer may add the same key after the read above, an upsert can't collide with it on a unique index
+                operations.append(ReplaceOne({**scope, key: document_key}, document, upsert=True))
+            else:
+                operations.append(InsertOne(document))
+            counts['inserted'] += 1
+        elif stored_hashes[document_key] != document[CONTENT_HASH_FIELD]:
+            operations.append(ReplaceOne({**scope, key: document_key}, document))
+            counts['updated'] += 1
+        else:
+            counts['unchanged'] += 1
+
+    stale_keys = [stored_key for stored_key in stored_hashes if stored_key not in seen_keys]
+    if stale_keys:
+        operations.append(DeleteMany({**scope, key: {'$in': stale_keys}}))
+
+    if operations:
+        result = collection.bulk_write(operations, ordered=False)
+        counts['deleted'] = result.deleted_count
+
+    logging.info(f"Synced {collection.name}: {counts['inserted']} inserted, {counts['updated']} updated, "
+                 f"{counts['deleted']} deleted, {counts['unchanged']} unchanged")
+    return counts
@@ -1,9 +1,10 @@
 import logging
 import azure.functions as func
-from pymongo import MongoClient, errors as mongo_errors
-from datetime import datetime
+from pymongo import MongoClient, UpdateOne, errors as mongo_errors
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import os
-import requests
+from BungieClient import BungieApiError, get_bungie_client
 
 try:
     client = MongoClient(os.environ.get('MONGODB_URI'))
@@ -17,18 +18,39 @@ except mongo_errors.PyMongoError as e:
 CLIENT_ID = os.environ.get('CLIENT_ID')
 CLIENT_SECRET = os.environ.get('CLIENT_SECRET')
 API_KEY = os.environ.get('API_KEY')
+OAUTH_REFRESH_WINDOW = int(os.environ.get('OAUTH_REFRESH_WINDOW', 4500))  # Refresh tokens expiring within this many seconds, longer than the hourly schedule
+OAUTH_REFRESH_CONCURRENCY = int(os.environ.get('OAUTH_REFRESH_CONCURRENCY', 8))  # Token refreshes in flight at once
         
+def tokens_due_for_refresh(now):
+    refresh_before = now + timedelta(seconds=OAUTH_REFRESH_WINDOW)
+    query = {
+        # Tokens stored before expiry tracking have no expires_at and are refreshed once to pick it up
+        '$or': [{'expires_at': {'$lte': refresh_before}}, {'expires_at': {'$exists': False}}],
+        # A refresh token past its own expiry can't be used, the user has to sign in again
+        'refresh_expires_at': {'$not': {'$lte': now}}
+    }
+    return collection.find(query, {'_id': 0, 'bungie_id': 1, 'refresh_token': 1})
+
 def refresh_all_tokens():
     try:
-        users = collection.find({})
-        for user in users:
-            new_tokens = refresh_access_token(user['refresh_token'])
-            if new_tokens:
-                store_in_db(user, new_tokens['access_token'], new_tokens['refresh_token'], True)
-                logging.info(f"Token refreshed for user: {user['bungie_id']}")
-            else:
-                logging.warning(f"Failed to refresh token for user: {user['bungie_id']}")
-        logging.info("All tokens processed.")
+        now = datetime.now()
+        users = list(tokens_due_for_refresh(now))
+        logging.info(f"{len(users)} tokens expire within {OAUTH_REFRESH_WINDOW}s and will be refreshed")
+
+        with ThreadPoolExecutor(max_workers=OAUTH_REFRESH_CONCURRENCY) as executor:
+            results = executor.map(lambda user: refresh_access_token(user['refresh_token']), users)
+
+            updates = []
+            for user, new_tokens in zip(users, results):
+                if new_tokens:
+                    updates.append(token_update(user, new_tokens, now))
+                    logging.info(f"Token refreshed for user: {user['bungie_id']}")
+                else:
+                    logging.warning(f"Failed to refresh token for user: {user['bungie_id']}")
+
+        if updates:
+            collection.bulk_write(updates, ordered=False)
+        logging.info(f"All tokens processed. Refreshed {len(updates)} of {len(users)}.")
     except Exception as e:
         logging.error(f"Error in refresh_all_tokens: {e}")
         raise
@@ -37,8 +59,7 @@ def refresh_access_token(refresh_token):
     try:
         url = 'https://www.bungie.net/platform/app/oauth/token/'
         headers = {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'X-API-Key': API_KEY
+            'Content-Type': 'application/x-www-form-urlencoded'
         }
         data = {
             'grant_type': 'refresh_token',
@@ -47,30 +68,22 @@ def refresh_access_token(refresh_token):
             'client_secret': CLIENT_SECRET
         }
 
-        response = requests.post(url, headers=headers, data=data)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            logging.error(f"Failed to refresh access token, status code: {response.status_code}")
-            return None
-    except requests.exceptions.RequestException as e:
-        logging.error(f"HTTP request error: {e}")
+        return get_bungie_client(API_KEY).post(url, headers=headers, data=data)
+    except BungieApiError as e:
+        logging.error(f"Failed to refresh access token: {e}")
         return None
     
-def store_in_db(user, access_token, refresh_token, refreshed):
-    try:
-        document = {
-            'bungie_id': user['bungie_id'],
-            'membership_type': user['membership_type'],
-            'destiny_membership_id': user.get('destiny_membership_id'),  # Use .get() to avoid KeyError
-            'display_name': user.get('display_name', 'Default Display Name'),
-            'icon_url': user.get('icon_url', 'Default Icon URL'),
-            'access_token': access_token,
-            'refresh_token': refresh_token,
-            'timestamp': datetime.now(),
-            'refreshed': refreshed
-        }
-        collection.replace_one({'bungie_id': user['bungie_id']}, document, upsert=True)
-    except mongo_errors.PyMongoError as e:
-        logging.error(f"MongoDB operation error for user {user['bungie_id']}: {e}")
-        raise
+def token_update(user, new_tokens, now):
+    fields = {
+        'access_token': new_tokens['access_token'],
+        'refresh_token': new_tokens['refresh_token'],
+        'timestamp': now,
+        'refreshed': True
+    }
+    # Bungie returns lifetimes in seconds, store them as absolute times so due tokens can be queried
+    if 'expires_in' in new_tokens:
+        fields['expires_at'] = now + timedelta(seconds=new_tokens['expires_in'])
+    if 'refresh_expires_in' in new_tokens:
+        fields['refresh_expires_at'] = now + timedelta(seconds=new_tokens['refresh_expires_in'])
+    # $set leaves the rest of the user's document untouched
+    return UpdateOne({'bungie_id': user['bungie_id']}, {'$set': fields})
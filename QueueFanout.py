@@ -0,0 +1,75 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from itertools import islice
+from azure.core.exceptions import AzureError
+from azure.storage.queue import BinaryBase64EncodePolicy
+from azure.storage.queue.aio import QueueClient
+
+STORAGE_CONNECTION_STRING = os.environ.get('AzureWebJobsStorage')  # Azure Storage connection string
+FANOUT_BATCH_SIZE = int(os.environ.get('FANOUT_BATCH_SIZE', 500))  # Users read from MongoDB per batch
+FANOUT_CONCURRENCY = int(os.environ.get('FANOUT_CONCURRENCY', 32))  # Queue sends in flight at once
+
+USER_MESSAGE_PROJECTION = {'_id': 0, 'bungie_id': 1, 'membership_type': 1, 'access_token': 1, 'destiny_membership_id': 1}
+
+
+def user_message(doc):
+    return json.dumps({
+        'bungie_id': doc['bungie_id'],
+        'membership_type': doc['membership_type'],
+        'access_token': doc['access_token'],
+        'destiny_membership_id': doc.get('destiny_membership_id')  # Use .get() to avoid KeyError
+    }).encode('utf-8')
+
+
+async def enqueue_users(db, queue_name, query=None):
+    # Stream UserDetails in batches and send one queue message per user, keeping FANOUT_CONCURRENCY sends in flight
+    loop = asyncio.get_running_loop()
+    cursor = db['UserDetails'].find(query or {}, USER_MESSAGE_PROJECTION).batch_size(FANOUT_BATCH_SIZE)
+    semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+    pending = set()
+    sent = 0
+    failed = 0
+    start = time.monotonic()
+
+    async with QueueClient.from_connection_string(STORAGE_CONNECTION_STRING, queue_name,
+                                                  message_encode_policy=BinaryBase64EncodePolicy()) as queue_client:
+        async def send(bungie_id, message):
+            nonlocal sent, failed
+            try:
+                await queue_client.send_message(message)
+                sent += 1
+            except AzureError as e:
+                failed += 1
+                # Log the user rather than the message, which carries their access token
+                logging.error(f"Failed to enqueue user {bungie_id} to {queue_name}: {e}")
+            finally:
+                semaphore.release()
+
+        while True:
+            # Pull the next batch off the cursor without blocking the sends already in flight
+            batch = await loop.run_in_executor(None, lambda: list(islice(cursor, FANOUT_BATCH_SIZE)))
+            if not batch:
+                break
+
+            for doc in batch:
+                await semaphore.acquire()
+                task = asyncio.create_task(send(doc['bungie_id'], user_message(doc)))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+
+        if pending:
+            await asyncio.gather(*pending)
+
+    elapsed = time.monotonic() - start
+    rate = sent / elapsed if elapsed > 0 else 0
+    logging.info(f"Enqueued {sent} users to {queue_name} in {elapsed:.2f}s ({rate:.0f} messages/s), {failed} failed")
+    return sent
+
+
+async def enqueue_user(queue_name, user):
+    async with QueueClient.from_connection_string(STORAGE_CONNECTION_STRING, queue_name,
+                                                  message_encode_policy=BinaryBase64EncodePolicy()) as queue_client:
+        await queue_client.send_message(user_message(user))
@@ -0,0 +1,41 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    # Client-side rate limiter shared by every thread and coroutine on a worker.
+    # Tokens refill at `rate` per second up to `capacity`; callers wait once the bucket runs dry.
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        # Take a token and return how many seconds the caller has to wait before using it
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds):
+        # Hold every caller back for at least `seconds`, e.g. when the server asks us to slow down
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
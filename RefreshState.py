@@ -0,0 +1,45 @@
+import logging
+import threading
+import time
+from datetime import datetime
+
+STATE_COLLECTION = 'RefreshState'  # One document per refreshed dataset, keyed by name
+
+
+def get_refresh_state(db, name):
+    state = db[STATE_COLLECTION].find_one({'_id': name})
+    return state if state else {}
+
+
+def set_refresh_state(db, name, **fields):
+    fields['timestamp'] = datetime.now()
+    db[STATE_COLLECTION].update_one({'_id': name}, {'$set': fields}, upsert=True)
+
+
+class VersionedCache:
+    # Keeps a value built from the database for the life of the worker and rebuilds it only
+    # when the version of the data behind it changes. The version is checked at most once per interval.
+    def __init__(self, name, load, get_version, check_interval):
+        self.name = name
+        self.load = load  # (db, version) -> value
+        self.get_version = get_version  # db -> version
+        self.check_interval = check_interval
+        self.value = None
+        self.version = None
+        self.checked = 0.0
+        self.lock = threading.Lock()
+
+    def get(self, db):
+        with self.lock:
+            now = time.monotonic()
+            if self.value is not None and now - self.checked < self.check_interval:
+                return self.value
+
+            version = self.get_version(db)
+            self.checked = now
+            if self.value is None or version != self.version:
+                self.value = self.load(db, version)
+                self.version = version
+                logging.info(f"Loaded {self.name} cache for version {version}")
+
+            return self.value
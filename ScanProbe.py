@@ -0,0 +1,38 @@
+import hashlib
+import logging
+import os
+
+SCAN_PROBE_ENABLED = os.environ.get('SCAN_PROBE_ENABLED', 'true').lower() == 'true'  # Skip full scans when the probe shows nothing changed
+PROBE_COMPONENTS = '200,102'  # Characters and vault only, no item components
+PROBE_STATS_ID = 'scan_probe'
+FINGERPRINT_FIELD = 'probe_fingerprint'
+
+# Per worker totals, the ScanStats collection holds the totals across workers
+probe_counters = {'hits': 0, 'misses': 0}
+
+
+def probe_fingerprint(profile_data):
+    # Anything that can add a weapon moves a character's play time or the set of instances in the vault
+    response = profile_data['Response']
+    characters = response['characters']['data']
+    parts = [f"{character_id}:{character.get('dateLastPlayed')}:{character.get('minutesPlayedThisSession')}"
+             for character_id, character in sorted(characters.items())]
+    vault_items = response['profileInventory']['data']['items']
+    parts.extend(sorted(item['itemInstanceId'] for item in vault_items if 'itemInstanceId' in item))
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def get_stored_fingerprint(db, bungie_id):
+    doc = db['UserInstanceList'].find_one({'bungieID': bungie_id}, {'_id': 0, FINGERPRINT_FIELD: 1})
+    return doc.get(FINGERPRINT_FIELD) if doc else None
+
+
+def store_fingerprint(db, bungie_id, fingerprint):
+    db['UserInstanceList'].update_one({'bungieID': bungie_id}, {'$set': {FINGERPRINT_FIELD: fingerprint}}, upsert=True)
+
+
+def record_probe_result(db, hit):
+    key = 'hits' if hit else 'misses'
+    probe_counters[key] += 1
+    db['ScanStats'].update_one({'_id': PROBE_STATS_ID}, {'$inc': {key: 1}}, upsert=True)
+    logging.info(f"Scan probe {'hit' if hit else 'miss'}, worker totals: {probe_counters}")
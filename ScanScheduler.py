@@ -0,0 +1,77 @@
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+SCAN_INTERVAL_ACTIVE = int(os.environ.get('SCAN_INTERVAL_ACTIVE', 300))  # Seconds, playing now or just found new weapons
+SCAN_INTERVAL_DAY = int(os.environ.get('SCAN_INTERVAL_DAY', 900))  # Seconds, played within the last day
+SCAN_INTERVAL_WEEK = int(os.environ.get('SCAN_INTERVAL_WEEK', 3600))  # Seconds, played within the last week
+SCAN_INTERVAL_MONTH = int(os.environ.get('SCAN_INTERVAL_MONTH', 21600))  # Seconds, played within the last month
+SCAN_INTERVAL_DORMANT = int(os.environ.get('SCAN_INTERVAL_DORMANT', 86400))  # Seconds, everyone else
+SCAN_DUE_SLACK = int(os.environ.get('SCAN_DUE_SLACK', 60))  # Seconds early a user may be picked up so a 5 minute check isn't pushed to the next tick
+
+
+def parse_bungie_date(value):
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return None
+
+
+def activity_signals(profile_data):
+    # Most recent play time and total minutes played across every character, from profile component 200
+    characters = profile_data.get('Response', {}).get('characters', {}).get('data', {})
+    last_played = None
+    minutes_played = 0
+    for character in characters.values():
+        played = parse_bungie_date(character.get('dateLastPlayed'))
+        if played and (last_played is None or played > last_played):
+            last_played = played
+        minutes_played += int(character.get('minutesPlayedTotal', 0))
+    return last_played, minutes_played
+
+
+def next_check_interval(last_played, minutes_changed, found_new_weapons, now):
+    if found_new_weapons or minutes_changed:
+        return SCAN_INTERVAL_ACTIVE
+    if last_played is None:
+        return SCAN_INTERVAL_DORMANT
+
+    idle = now - last_played
+    if idle <= timedelta(days=1):
+        return SCAN_INTERVAL_DAY
+    if idle <= timedelta(days=7):
+        return SCAN_INTERVAL_WEEK
+    if idle <= timedelta(days=30):
+        return SCAN_INTERVAL_MONTH
+    return SCAN_INTERVAL_DORMANT
+
+
+def schedule_next_check(db, bungie_id, profile_data, found_new_weapons):
+    collection = db['UserDetails']
+    now = datetime.now(timezone.utc)
+    last_played, minutes_played = activity_signals(profile_data)
+
+    previous = collection.find_one({'bungie_id': bungie_id}, {'_id': 0, 'minutes_played_total': 1}) or {}
+    # Minutes played only move between scans while the user is in the game
+    minutes_changed = previous.get('minutes_played_total') not in (None, minutes_played)
+
+    interval = next_check_interval(last_played, minutes_changed, found_new_weapons, now)
+    next_check_at = now + timedelta(seconds=interval)
+    collection.update_one({'bungie_id': bungie_id}, {'$set': {
+        'next_check_at': next_check_at,
+        'last_played_at': last_played,
+        'minutes_played_total': minutes_played
+    }})
+    logging.info(f"Next scan for user ID: {bungie_id} in {interval}s")
+    return next_check_at
+
+
+def mark_due(db, bungie_id):
+    # Pull the user into the next timer run, e.g. when they open the app
+    db['UserDetails'].update_one({'bungie_id': bungie_id}, {'$set': {'next_check_at': datetime.now(timezone.utc)}})
+
+
+def due_users_query():
+    due_by = datetime.now(timezone.utc) + timedelta(seconds=SCAN_DUE_SLACK)
+    # Users never scheduled yet are due straight away
+    return {'$or': [{'next_check_at': {'$lte': due_by}}, {'next_check_at': {'$exists': False}}]}
@@ -1,11 +1,19 @@
+import asyncio
+import aiohttp
 import requests
 from bs4 import BeautifulSoup
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 import datetime
 import json
 import time
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pymongo import DeleteMany, ReplaceOne, UpdateOne
+from RefreshState import set_refresh_state
+from MongoSync import content_hash
+from RateLimiter import TokenBucket
+from GodRollParser import parse_weapon_page
 from azure.storage.queue import (
         QueueClient,
         BinaryBase64EncodePolicy,
@@ -14,13 +22,27 @@ from azure.storage.queue import (
 
 STORAGE_CONNECTION_STRING = os.environ['AzureWebJobsStorage']  # Azure Storage connection string
 QUEUE_NAME = 'dailyinvqueue'  # Azure Queue name
+SCRAPER_CONCURRENCY = int(os.environ.get('SCRAPER_CONCURRENCY', 10))  # Pages in flight at once
+SCRAPER_RATE_LIMIT = float(os.environ.get('SCRAPER_RATE_LIMIT', 8))  # Requests per second across the whole crawl
+SCRAPER_TIMEOUT = float(os.environ.get('SCRAPER_TIMEOUT', 30))  # Seconds per page
+SCRAPER_PROGRESS_INTERVAL = 100  # Pages between progress logs
+SCRAPE_STATE_COLLECTION = 'GodRollScrapeState'  # Per weapon ETag, Last-Modified and content hash from the last crawl
+SCRAPER_PARSE_WORKERS = int(os.environ.get('SCRAPER_PARSE_WORKERS', min(2, os.cpu_count() or 1)))  # Parser processes, 0 parses on a thread instead. cpu_count is the host's on consumption plans
+SCRAPER_QUEUE_SIZE = int(os.environ.get('SCRAPER_QUEUE_SIZE', 20))  # Pages held between stages before upstream waits
+SCRAPER_WRITE_BATCH = int(os.environ.get('SCRAPER_WRITE_BATCH', 100))  # Parsed weapons per database write
+
+SCRAPER_HEADERS = {
+    # Set a User-Agent header to mimic a browser request
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+}
 
 
 def generate_urls(db):
     collection = db["WeaponDetails"]
 
     urls_and_names = []
-    for weapon in collection.find():
+    # Fixed roll weapons have no community perk rankings worth fetching
+    for weapon in collection.find({'randomRoll': True}, {'_id': 0, 'id': 1, 'name': 1}):
         name_for_url = weapon['name'].replace(' ', '-').lower()
         url = f"https://www.light.gg/db/items/{weapon['id']}/{name_for_url}/"
         urls_and_names.append({'url': url, 'name': weapon['name'], 'id': weapon['id']})
@@ -29,105 +51,28 @@ def generate_urls(db):
 
     return urls_and_names
 
-def fetch_weapon_details(weapon, session):
-    # Set a User-Agent header to mimic a browser request
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-    }
+async def fetch_weapon_page(weapon, session, limiter, validators=None):
+    # Returns ('fetched', html, etag, last_modified), ('unchanged', ...) on a 304 or ('failed', ...)
+    headers = {}
+    if validators and validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators and validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
 
     try:
-        # Use the session with headers for the request
-        response = session.get(weapon['url'], headers=headers)
-        if not response.ok:  # response.ok is True for HTTP status codes 2xx
-            print(f"ScrapingLOG: Failed to fetch {weapon['url']}: {response.status_code}")
-            return None, []
-
-        soup = BeautifulSoup(response.text, 'html.parser')
-        community_average_div = soup.find('div', id='community-average')
-        masterwork_div = soup.find('div', id='masterwork-stats')
-        mods_div = soup.find('div', id='mod-stats')
-        weapon_details = {'weaponHash': weapon['id'], 'sockets_details': [], 'masterworks': [], 'mods': []}
-
-        all_perk_names = []
-
-        if community_average_div:
-            containers = community_average_div.find_all('ul', class_='list-unstyled sockets')
-            for container in containers:
-                socket_details = []
-                list_items = container.find_all('li')
-                for item in list_items:
-                    percent_div = item.find('div', class_='percent')
-                    percentage = percent_div.text.strip() if percent_div else None
-
-                    image = item.find('img')
-                    alt_text = image.get('alt') if image else None
-                    
-                    if alt_text: all_perk_names.append(alt_text)
-
-                    item_detail = {
-                        'percentage': percentage,
-                        'name': alt_text,
-                    }
-                    socket_details.append(item_detail)
-                
-                if socket_details:
-                    weapon_details['sockets_details'].append(socket_details)
-                    
-        if masterwork_div:
-            masterwork_blocks = masterwork_div.find_all('div', class_='clearfix')
-            for block in masterwork_blocks:
-                perk_container = block.find('div', class_='perk-container')
-                if perk_container:
-                    item = perk_container.find('div', class_='item')
-                    if item:
-                        data_id = item.get('data-id')
-                        img_tag = item.find('img')
-                        image_url = img_tag.get('src') if img_tag else None
-                        alt_text = img_tag.get('alt') if img_tag else None
-
-                        # Getting percentage
-                        percent_div = block.find('div', class_='combo-percent')
-                        percentage = percent_div.text.strip() if percent_div else None
-
-                        masterwork_details = {
-                            'id': data_id,
-                            'name': alt_text,
-                            'image_url': image_url,
-                            'percentage': percentage
-                        }
-                        weapon_details['masterworks'].append(masterwork_details)
-                        
-        if mods_div:
-            mod_blocks = mods_div.find_all('div', class_='clearfix')
-            for block in mod_blocks:
-                perk_container = block.find('div', class_='perk-container')
-                if perk_container:
-                    item = perk_container.find('div', class_='item')
-                    if item:
-                        data_id = item.get('data-id')
-                        img_tag = item.find('img')
-                        image_url = img_tag.get('src') if img_tag else None
-                        alt_text = img_tag.get('alt') if img_tag else None
-
-                        # Getting percentage
-                        percent_div = block.find('div', class_='combo-percent')
-                        percentage = percent_div.text.strip() if percent_div else None
-
-                        mod_details = {
-                            'id': data_id,
-                            'name': alt_text,
-                            'image_url': image_url,
-                            'percentage': percentage
-                        }
-                        weapon_details['mods'].append(mod_details)
-
-        # Delay to avoid hitting the server too frequently
-        time.sleep(1)
-
-        return (weapon_details, all_perk_names)
+        # One shared limiter paces the whole crawl instead of a sleep after every page
+        await limiter.acquire_async()
+        async with session.get(weapon['url'], headers=headers) as response:
+            if response.status == 304:
+                return 'unchanged', None, None, None
+            if not 200 <= response.status < 300:
+                print(f"ScrapingLOG: Failed to fetch {weapon['url']}: {response.status}")
+                return 'failed', None, None, None
+            html = await response.text()
+            return 'fetched', html, response.headers.get('ETag'), response.headers.get('Last-Modified')
     except Exception as e:
-        print(f"ScrapingLOG: Error fetching details for {weapon['url']}: {e}")
-        return None, []
+        print(f"ScrapingLOG: Error fetching details for {weapon['url']}: {e!r}")
+        return 'failed', None, None, None
 
 def find_hashes_by_names(db, all_perk_names):
     collection = db['PerkDetails']
@@ -147,39 +92,158 @@ def find_hashes_by_names(db, all_perk_names):
 
     return found_hashes
 
-def scrape_details_and_save(urls_and_names, db):
-    collection = db["GodRolls"]
-    session = requests.Session()
-    weapon_details_list = []
-
-    logging.info(f"ScrapingLOG: Scraping details for {len(urls_and_names)} weapons.")
-
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_weapon = {executor.submit(fetch_weapon_details, weapon, session): weapon for weapon in urls_and_names}
-        counter = 0
-        all_perk_names = []  # Collect all perk names first to minimize database queries
-        for future in as_completed(future_to_weapon):
-            weapon_details, weapon_perk_names = future.result()
-            if weapon_details and weapon_details['sockets_details']:
-                all_perk_names.extend(weapon_perk_names)  # Append perks for later processing
-                weapon_details_list.append(weapon_details)
+async def crawl_weapon_details(urls_and_names, db, scrape_state=None, concurrency=SCRAPER_CONCURRENCY, rate=SCRAPER_RATE_LIMIT,
+                               parse_workers=SCRAPER_PARSE_WORKERS):
+    # Three stages joined by bounded queues: async fetchers -> parser processes -> batched database writer.
+    # A full queue makes the stage before it wait, so memory stays flat however far ahead downloads get.
+    scrape_state = scrape_state or {}
+    loop = asyncio.get_running_loop()
+    raw_pages = asyncio.Queue(maxsize=SCRAPER_QUEUE_SIZE)
+    parsed_pages = asyncio.Queue(maxsize=SCRAPER_QUEUE_SIZE)
+    counts = {'fetched': 0, 'unchanged': 0, 'failed': 0}
+    totals = {'changed': 0, 'removed': 0, 'written': 0}
+    weapons = iter(urls_and_names)
+    limiter = TokenBucket(rate, 1)
+    parser_count = max(parse_workers, 1)
+    counter = 0
+    start = time.monotonic()
+
+    async def fetcher(session):
+        nonlocal counter
+        # Fetchers share one iterator, so each weapon is fetched exactly once
+        for weapon in weapons:
+            status, html, etag, last_modified = await fetch_weapon_page(weapon, session, limiter, scrape_state.get(weapon['id']))
+            if status == 'fetched':
+                await raw_pages.put((weapon, html, etag, last_modified))
+            else:
+                counts[status] += 1
             counter += 1
-            if counter % 100 == 0:
-                logging.info(f"ScrapingLOG: Scraped details for {counter} weapons.")
-
-    # Find perk hashes after collecting all perk names to reduce DB queries
-    perk_hashes = find_hashes_by_names(db, all_perk_names)
-    for weapon_details in weapon_details_list:
+            if counter % SCRAPER_PROGRESS_INTERVAL == 0:
+                elapsed = time.monotonic() - start
+                logging.info(f"ScrapingLOG: Scraped details for {counter}/{len(urls_and_names)} weapons ({counter / elapsed:.1f} pages/s), "
+                             f"{raw_pages.qsize()} waiting to parse, {totals['written']} written.")
+
+    async def fetch_all(session):
+        await asyncio.gather(*[fetcher(session) for _ in range(concurrency)])
+        for _ in range(parser_count):
+            await raw_pages.put(None)
+
+    async def parser(pool):
+        while (page := await raw_pages.get()) is not None:
+            weapon, html, etag, last_modified = page
+            # Parsing is CPU bound, so it runs in another process while this one keeps downloading
+            weapon_details, weapon_perk_names = await loop.run_in_executor(pool, parse_weapon_page, html, weapon['id'])
+            if weapon_details is None:
+                counts['failed'] += 1
+                continue
+            counts['fetched'] += 1
+            await parsed_pages.put({'weapon': weapon, 'details': weapon_details, 'perk_names': weapon_perk_names,
+                                    'etag': etag, 'last_modified': last_modified})
+
+    async def parse_all(pool):
+        await asyncio.gather(*[parser(pool) for _ in range(parser_count)])
+        await parsed_pages.put(None)
+
+    async def writer():
+        batch = []
+        while True:
+            page = await parsed_pages.get()
+            if page is not None:
+                batch.append(page)
+            if batch and (page is None or len(batch) >= SCRAPER_WRITE_BATCH):
+                changed, removed = await loop.run_in_executor(None, write_god_roll_batch, db, batch, scrape_state)
+                totals['changed'] += changed
+                totals['removed'] += removed
+                totals['written'] += len(batch)
+                batch = []
+            if page is None:
+                return
+
+    # Spawn rather than fork, forking would copy the Functions worker along with its live gRPC and MongoDB threads
+    pool = ProcessPoolExecutor(max_workers=parse_workers, mp_context=multiprocessing.get_context('spawn')) if parse_workers > 0 else None
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=SCRAPER_TIMEOUT)
+    try:
+        # One pooled session for the whole crawl
+        async with aiohttp.ClientSession(headers=SCRAPER_HEADERS, connector=connector, timeout=timeout) as session:
+            stages = [asyncio.create_task(stage) for stage in (fetch_all(session), parse_all(pool), writer())]
+            try:
+                await asyncio.gather(*stages)
+            except BaseException:
+                # A failed stage would leave the others waiting on its queue
+                for stage in stages:
+                    stage.cancel()
+                raise
+    finally:
+        if pool:
+            pool.shutdown()
+
+    elapsed = time.monotonic() - start
+    logging.info(f"ScrapingLOG: Crawled {counter} pages in {elapsed:.1f}s ({counter / elapsed if elapsed else 0:.1f} pages/s) "
+                 f"with {concurrency} fetchers at up to {rate} requests/s and {parse_workers} parser processes: "
+                 f"{counts['fetched']} fetched, {counts['unchanged']} not modified, {counts['failed']} failed.")
+    return totals
+
+def load_scrape_state(db):
+    return {state['_id']: state for state in db[SCRAPE_STATE_COLLECTION].find({})}
+
+def write_god_roll_batch(db, pages, scrape_state):
+    operations = []
+    state_updates = []
+    changed = 0
+
+    # Find perk hashes for the whole batch at once to reduce DB queries
+    perk_hashes = find_hashes_by_names(db, [name for page in pages for name in page['perk_names']])
+    for page in pages:
+        weapon_details = page['details']
+        weapon_hash = weapon_details['weaponHash']
         for socket in weapon_details['sockets_details']:
             for item in socket:
                 if item['name'] in perk_hashes:
                     item['socketHash'] = perk_hashes[item['name']]
 
-    # Database operations
-    if weapon_details_list:
-        collection.delete_many({})
-        collection.insert_many(weapon_details_list)
-    logging.info(f"ScrapingLOG: Inserted {len(weapon_details_list)} weapons into MongoDB.")
+        # The hash covers only what we extract from the page, so layout or ad changes don't count as changes
+        digest = content_hash(weapon_details)
+        if digest != scrape_state.get(weapon_hash, {}).get('content_hash'):
+            changed += 1
+            if weapon_details['sockets_details']:
+                operations.append(ReplaceOne({'weaponHash': weapon_hash}, weapon_details, upsert=True))
+            else:
+                operations.append(DeleteMany({'weaponHash': weapon_hash}))
+        state_updates.append(UpdateOne({'_id': weapon_hash}, {'$set': {
+            'etag': page['etag'], 'last_modified': page['last_modified'], 'content_hash': digest, 'checked_at': datetime.datetime.now()
+        }}, upsert=True))
+
+    removed = 0
+    if operations:
+        removed = db["GodRolls"].bulk_write(operations, ordered=False).deleted_count
+    # Record validators only once the god rolls they describe are stored
+    db[SCRAPE_STATE_COLLECTION].bulk_write(state_updates, ordered=False)
+    return changed, removed
+
+def finish_god_rolls(db, urls_and_names, totals):
+    collection = db["GodRolls"]
+    removed = totals['removed']
+    if urls_and_names:
+        # Drop god rolls for weapons that are no longer random rolled or no longer exist
+        weapon_hashes = [weapon['id'] for weapon in urls_and_names]
+        removed += collection.delete_many({'weaponHash': {'$nin': weapon_hashes}}).deleted_count
+        db[SCRAPE_STATE_COLLECTION].delete_many({'_id': {'$nin': weapon_hashes}})
+
+    if totals['changed'] or removed:
+        # Let cached god roll indexes know the data changed
+        set_refresh_state(db, 'GodRolls', version=datetime.datetime.now().isoformat(), count=collection.estimated_document_count())
+    logging.info(f"ScrapingLOG: Wrote {totals['changed']} changed weapons and removed {removed} god rolls in MongoDB, "
+                 f"{totals['written'] - totals['changed']} fetched pages were unchanged.")
+
+async def scrape_details_and_save(urls_and_names, db):
+    logging.info(f"ScrapingLOG: Scraping details for {len(urls_and_names)} weapons.")
+
+    # The Mongo reads and writes around the crawl block, so they run on threads like the batch writes
+    loop = asyncio.get_running_loop()
+    scrape_state = await loop.run_in_executor(None, load_scrape_state, db)
+    totals = await crawl_weapon_details(urls_and_names, db, scrape_state)
+    await loop.run_in_executor(None, finish_god_rolls, db, urls_and_names, totals)
     
 def getGodRollOverview():
     url = 'https://www.light.gg/'  # URL of Light.gg
@@ -187,7 +251,7 @@ def getGodRollOverview():
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
     }
 
-    response = requests.get(url, headers=headers)
+    response = requests.get(url, headers=headers, timeout=SCRAPER_TIMEOUT)
     if response.ok:
         soup = BeautifulSoup(response.text, 'html.parser')
         
@@ -222,20 +286,25 @@ def StorePopularIds(db, popular_ids):
     collection.insert_one({"popular_ids": popular_ids})
     logging.info(f"ScrapingLOG: Stored {len(popular_ids)} popular God Rolls in MongoDB.")
 
-def ScrapeGodRolls(db):
+async def ScrapeGodRolls(db):
     start_time = datetime.datetime.now()  # Record the start time
     
-    popular_ids = getGodRollOverview()
-    StorePopularIds(db, popular_ids)
+    # requests, pymongo and the sync queue client block, so keep them off the worker's event loop
+    loop = asyncio.get_running_loop()
+    popular_ids = await loop.run_in_executor(None, getGodRollOverview)
+    await loop.run_in_executor(None, StorePopularIds, db, popular_ids)
 
-    urls_and_names = generate_urls(db)
-    scrape_details_and_save(urls_and_names, db)
+    urls_and_names = await loop.run_in_executor(None, generate_urls, db)
+    await scrape_details_and_save(urls_and_names, db)
 
     end_time = datetime.datetime.now()  # Record the end time
     duration = end_time - start_time  # Calculate the duration
 
     logging.info(f"ScrapingLOG: Scraping completed and details saved to MongoDB collection. Time taken: {duration}")
 
+    await loop.run_in_executor(None, send_inventory_scan_message)
+
+def send_inventory_scan_message():
     queue_client = QueueClient.from_connection_string(STORAGE_CONNECTION_STRING, QUEUE_NAME)
     
     queue_client.message_encode_policy = BinaryBase64EncodePolicy()
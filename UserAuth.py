@@ -0,0 +1,16 @@
+import hmac
+
+
+def bearer_token(authorization):
+    # 'Bearer <token>' from an Authorization header, None for anything else
+    scheme, _, token = (authorization or '').partition(' ')
+    return (token.strip() or None) if scheme.lower() == 'bearer' else None
+
+
+def user_token_matches(db, bungie_id, access_token):
+    # Anonymous endpoints only serve or touch a user's data for the token stored with that user
+    if not bungie_id or not isinstance(access_token, str) or not access_token:
+        return False
+    user = db['UserDetails'].find_one({'bungie_id': bungie_id}, {'_id': 0, 'access_token': 1})
+    stored_token = user.get('access_token') if user else None
+    return isinstance(stored_token, str) and hmac.compare_digest(stored_token.encode('utf-8'), access_token.encode('utf-8'))
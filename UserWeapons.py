@@ -0,0 +1,95 @@
+import base64
+import json
+import os
+import re
+from pymongo import ReplaceOne
+from MongoSync import CONTENT_HASH_FIELD, content_hash, sync_collection
+
+USER_WEAPONS_COLLECTION = 'UserWeapons'  # One document per appraised weapon, keyed by (bungie_id, itemId)
+INVENTORY_STORAGE_MODE = os.environ.get('INVENTORY_STORAGE_MODE', 'weapons')  # 'weapons' (UserWeapons, header in UserInventory), 'document' (UserInventory) or 'both'
+USER_WEAPONS_PAGE_SIZE = int(os.environ.get('USER_WEAPONS_PAGE_SIZE', 50))  # Default page size for readers
+USER_WEAPONS_MAX_PAGE_SIZE = int(os.environ.get('USER_WEAPONS_MAX_PAGE_SIZE', 200))  # Largest page a client may ask for
+FIELD_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z0-9_]+)*$')
+
+WEAPON_SORT = [('score_float', -1), ('itemId', 1)]
+
+
+def weapon_documents(inventory):
+    # Split an appraised inventory into per-weapon documents. The scan timestamp stays out so unchanged weapons hash the same.
+    return [dict(weapon, bungie_id=inventory['bungie_id'], destiny_id=inventory['destiny_id']) for weapon in inventory['weapons']]
+
+
+def sync_user_weapons(db, inventory):
+    # Upsert only the weapons whose content changed and delete the ones no longer in the inventory
+    return sync_collection(db[USER_WEAPONS_COLLECTION], weapon_documents(inventory), 'itemId', {'bungie_id': inventory['bungie_id']})
+
+
+def upsert_user_weapons(db, bungie_id, destiny_id, weapons):
+    # Add or replace individual weapons, e.g. the new ones a scan found, without touching the rest
+    operations = []
+    for weapon in weapons:
+        document = dict(weapon, bungie_id=bungie_id, destiny_id=destiny_id)
+        document[CONTENT_HASH_FIELD] = content_hash(document)
+        operations.append(ReplaceOne({'bungie_id': bungie_id, 'itemId': document['itemId']}, document, upsert=True))
+    if operations:
+        db[USER_WEAPONS_COLLECTION].bulk_write(operations, ordered=False)
+
+
+def weapon_filters(min_score=None, weapon_type=None, character_id=None, name_prefix=None):
+    # Every filter maps to a field that leads an index after bungie_id
+    filters = {}
+    if min_score is not None:
+        filters['score_float'] = {'$gte': min_score}
+    if weapon_type:
+        filters['weaponType'] = weapon_type
+    if character_id:
+        filters['characterId'] = character_id
+    if name_prefix:
+        # Anchored and case sensitive so the weaponName index bounds the scan
+        filters['weaponName'] = {'$regex': f'^{re.escape(name_prefix)}'}
+    return filters
+
+
+def encode_cursor(after):
+    return base64.urlsafe_b64encode(json.dumps(after).encode('utf-8')).decode('ascii') if after else None
+
+
+def decode_cursor(cursor):
+    # Raises ValueError for anything that isn't a cursor this module handed out
+    try:
+        score_float, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(score_float, (int, float)) or not isinstance(item_id, str):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return score_float, item_id
+
+
+def parse_projection(fields):
+    if not fields:
+        return None
+    projection = [field.strip() for field in fields.split(',') if field.strip()]
+    invalid = [field for field in projection if not FIELD_NAME.match(field)]
+    if invalid:
+        raise ValueError(f"Invalid fields: {', '.join(invalid)}")
+    return projection
+
+
+def find_user_weapons(db, bungie_id, page_size=USER_WEAPONS_PAGE_SIZE, after=None, filters=None, projection=None):
+    # One page of a user's weapons, best score first. after is the (score_float, itemId) of the last weapon on the previous page.
+    query = {'bungie_id': bungie_id}
+    if filters:
+        query.update(filters)
+    if after is not None:
+        score_float, item_id = after
+        query['$or'] = [{'score_float': {'$lt': score_float}}, {'score_float': score_float, 'itemId': {'$gt': item_id}}]
+
+    if projection is None:
+        projection = {'_id': 0, CONTENT_HASH_FIELD: 0}
+    else:
+        # The cursor fields are always returned so the next page can be requested
+        projection = dict({field: 1 for field in projection}, _id=0, score_float=1, itemId=1)
+
+    weapons = list(db[USER_WEAPONS_COLLECTION].find(query, projection).sort(WEAPON_SORT).limit(page_size))
+    next_after = (weapons[-1]['score_float'], weapons[-1]['itemId']) if len(weapons) == page_size else None
+    return weapons, next_after
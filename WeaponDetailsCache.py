@@ -0,0 +1,25 @@
+import os
+from GetManifest import get_ingested_manifest
+from RefreshState import VersionedCache
+
+WEAPON_CACHE_CHECK_INTERVAL = int(os.environ.get('WEAPON_CACHE_CHECK_INTERVAL', 300))  # Seconds between manifest version checks
+
+
+def manifest_version(db):
+    return get_ingested_manifest(db).get('version')
+
+
+def load_weapon_details(db, version):
+    collection = db['WeaponDetails']
+
+    data = collection.find({}, {'_id': 0, 'id': 1, 'name': 1, 'rarity': 1, 'iconPath': 1, 'type': 1})
+
+    return {weapon['id']: {'name': weapon['name'], 'tierTypeName': weapon['rarity'], 'icon': weapon['iconPath'], 'type': weapon.get('type')} for weapon in data}
+
+
+_weapon_details_cache = VersionedCache('WeaponDetails', load_weapon_details, manifest_version, WEAPON_CACHE_CHECK_INTERVAL)
+
+
+def get_weapon_details(db):
+    # hash -> {name, tierTypeName, icon, type}, shared by every scan on this worker until the manifest changes
+    return _weapon_details_cache.get(db)
@@ -8,11 +8,12 @@ from InventoryReader import GetInventory
 import os
 from datetime import datetime
 from pymongo import MongoClient
-from azure.storage.queue import (
-        QueueClient,
-        BinaryBase64EncodePolicy,
-        BinaryBase64DecodePolicy
-)
+from QueueFanout import enqueue_users, enqueue_user
+from UserWeapons import USER_WEAPONS_PAGE_SIZE, USER_WEAPONS_MAX_PAGE_SIZE, weapon_filters, encode_cursor, decode_cursor, parse_projection, find_user_weapons
+from InventoryCache import INVENTORY_REFRESH_QUEUE, load_stored_inventory, inventory_etag, etag_matches, is_stale, claim_refresh
+from ScanScheduler import due_users_query, mark_due
+from Indexes import ensure_indexes_on_startup
+from UserAuth import bearer_token, user_token_matches
 import json
 import asyncio
 
@@ -24,57 +25,31 @@ QUEUE_NAME = 'userinvcheck'  # Azure Queue name
 
 clent = MongoClient(MONGODB_URI)
 db = clent[DB_NAME]
+ensure_indexes_on_startup(db)
 
 app = func.FunctionApp()
 
 @app.schedule(schedule="0 */5 * * * *", arg_name="enqueueUserChecks", run_on_startup=True,
               use_monitor=True) 
-def userQueueTimer(enqueueUserChecks: func.TimerRequest) -> None:
+async def userQueueTimer(enqueueUserChecks: func.TimerRequest) -> None:
     if enqueueUserChecks.past_due:
         logging.info('The timer is past due!')
-        
-    queue_client = QueueClient.from_connection_string(STORAGE_CONNECTION_STRING, QUEUE_NAME)
-
-    queue_client.message_encode_policy = BinaryBase64EncodePolicy()
-    queue_client.message_decode_policy = BinaryBase64DecodePolicy()
-        
-    collection = db['UserDetails']
-        
-    cursor = collection.find({}, {'bungie_id': 1, 'membership_type': 1, "access_token": 1, "destiny_membership_id": 1})
-    user_data = [{
-        'bungie_id': doc['bungie_id'],
-        'membership_type': doc['membership_type'],
-        'access_token': doc['access_token'],
-        'destiny_membership_id': doc.get('destiny_membership_id')  # Use .get() to avoid KeyError
-    } for doc in cursor]
-
-    logging.info(user_data)
-
-    # Enqueue each user ID, membership type, and destiny membership id
-    for user in user_data:
-        message = json.dumps(user)        
-        logging.info(f"Enqueueing user data: {message}")
-
-        message_bytes =  message.encode('utf-8')
-        
-        queue_client.send_message(
-        queue_client.message_encode_policy.encode(content=message_bytes)
-        )
 
-    logging.info(f"Enqueued {len(user_data)} user checks.")
+    # Stream the users whose next scan is due into the scan queue with concurrent sends
+    await enqueue_users(db, QUEUE_NAME, due_users_query())
 
     logging.info('Python timer trigger function executed.')
     
 
 
 @app.queue_trigger(arg_name="azqueue", queue_name="userinvcheck", connection="AzureWebJobsStorage")
-def readQueueInventoryScanner(azqueue: func.QueueMessage):
+async def readQueueInventoryScanner(azqueue: func.QueueMessage):
     try:
         message_content = azqueue.get_body().decode('utf-8')
         logging.info(f"Processing User message")
         userDetails = json.loads(message_content)
         logging.info(userDetails)
-        ProcessQueueMessage(userDetails)
+        await ProcessQueueMessage(userDetails)
     except Exception as e:
         logging.error(f"Error processing message: {e}")
         raise e
@@ -112,45 +87,22 @@ def RollRadarDailyRefresh(dailyRefresh: func.TimerRequest) -> None:
         
         
 @app.queue_trigger(arg_name="godrollscraper", queue_name="godrollqueue", connection="AzureWebJobsStorage")
-def ScrapeGodRoll(godrollscraper: func.QueueMessage):
+async def ScrapeGodRoll(godrollscraper: func.QueueMessage):
     try:        
         message_content = godrollscraper.get_body().decode('utf-8')
         queuetime = json.loads(message_content)
         
-        ScrapeGodRolls(db)
+        await ScrapeGodRolls(db)
         
         logging.info("Scraped God Rolls")
     except Exception as e:
         logging.error(f"Error scraping godrolls: {e}")
 
 @app.queue_trigger(arg_name="invenqueue", queue_name="dailyinvqueue", connection="AzureWebJobsStorage")
-def EnqueueInvDaily(invenqueue: func.QueueMessage):
+async def EnqueueInvDaily(invenqueue: func.QueueMessage):
     try:
         logging.info(f"Processing User message")
-        queue_client = QueueClient.from_connection_string(STORAGE_CONNECTION_STRING, "dailyinvusers")
-
-        queue_client.message_encode_policy = BinaryBase64EncodePolicy()
-        queue_client.message_decode_policy = BinaryBase64DecodePolicy()
-            
-        collection = db['UserDetails']
-            
-        cursor = collection.find({}, {'bungie_id': 1, 'membership_type': 1, "access_token": 1, "destiny_membership_id": 1})
-        user_data = [{'bungie_id': doc['bungie_id'], 'membership_type': doc['membership_type'], 'access_token' : doc['access_token'], 'destiny_membership_id': doc['destiny_membership_id']} for doc in cursor]
-
-        logging.info(user_data)
-
-        # Enqueue each user ID, membership type, and destiny membership id
-        for user in user_data:
-            message = json.dumps(user)        
-            logging.info(f"Enqueueing user data: {message}")
-
-            message_bytes =  message.encode('utf-8')
-            
-            queue_client.send_message(
-            queue_client.message_encode_policy.encode(content=message_bytes)
-            )
-
-        logging.info(f"Enqueued {len(user_data)} user checks.")
+        await enqueue_users(db, "dailyinvusers")
 
         logging.info('Python timer trigger function executed.')
     except Exception as e:
@@ -159,7 +111,7 @@ def EnqueueInvDaily(invenqueue: func.QueueMessage):
 
 
 @app.queue_trigger(arg_name="dailyinvscan", queue_name="dailyinvusers", connection="AzureWebJobsStorage")
-def DailyInvCheck(dailyinvscan: func.QueueMessage):
+async def DailyInvCheck(dailyinvscan: func.QueueMessage):
     try:
         message_content = dailyinvscan.get_body().decode('utf-8')
         logging.info(f"Processing User message")
@@ -169,7 +121,7 @@ def DailyInvCheck(dailyinvscan: func.QueueMessage):
         access_token = userDetails['access_token']
         destiny_membership_id = userDetails['destiny_membership_id']
         
-        asyncio.run(run_async_inventory(db, bungieId, membershipType, destiny_membership_id,access_token))
+        await run_async_inventory(db, bungieId, membershipType, destiny_membership_id,access_token)
     except Exception as e:
         logging.error(f"Error processing message: {e}")
         raise e   
@@ -177,7 +129,7 @@ def DailyInvCheck(dailyinvscan: func.QueueMessage):
 
 
 @app.route('dailyinvscan', methods=['POST'], auth_level=func.AuthLevel.ANONYMOUS)
-def HttpDailyInvScan(req: func.HttpRequest):
+async def HttpDailyInvScan(req: func.HttpRequest):
     userDetails = req.get_json()
 
     required_keys = ['bungie_id', 'membership_type', 'access_token', 'destiny_membership_id']
@@ -192,18 +144,62 @@ def HttpDailyInvScan(req: func.HttpRequest):
         membershipType = userDetails['membership_type']
         access_token = userDetails['access_token']
         destiny_membership_id = userDetails['destiny_membership_id']
-        
-        inventory = asyncio.run(run_async_inventory(db, bungieId, membershipType, destiny_membership_id,access_token))
+
+        # pymongo blocks, so the Mongo calls run on threads and the worker's event loop stays free
+        loop = asyncio.get_running_loop()
+
+        # Check the token before reading the stored inventory or queueing anything with it
+        if not await loop.run_in_executor(None, user_token_matches, db, bungieId, access_token):
+            return func.HttpResponse("Invalid access token for this user.", status_code=401)
+
+        # Serve the stored inventory straight away and only scan live when there is none yet
+        inventory = await loop.run_in_executor(None, load_stored_inventory, db, bungieId)
+        if inventory is None:
+            inventory = await run_async_inventory(db, bungieId, membershipType, destiny_membership_id,access_token)
+        elif is_stale(inventory) and await loop.run_in_executor(None, claim_refresh, db, bungieId):
+            # Stale while revalidate: answer with what we have and rescan in the background. The user has the app
+            # open, so also have the scanner pick them up on its next run.
+            await loop.run_in_executor(None, mark_due, db, bungieId)
+            await enqueue_user(INVENTORY_REFRESH_QUEUE, userDetails)
+            logging.info(f"Queued a background inventory refresh for Bungie ID {bungieId}")
     except Exception as e:
         logging.error(f"Error processing message: {e}")
         raise e
     
     if inventory is not None:
-        return func.HttpResponse(json.dumps(inventory, cls=DateTimeEncoder), mimetype="application/json")
+        headers = {'ETag': inventory_etag(inventory), 'Cache-Control': 'private, no-cache'}
+        if etag_matches(req.headers.get('If-None-Match'), headers['ETag']):
+            return func.HttpResponse(status_code=304, headers=headers)
+        return func.HttpResponse(json.dumps(inventory, cls=DateTimeEncoder), mimetype="application/json", headers=headers)
     else:
         return func.HttpResponse("No inventory found for this user.", status_code=404)
 
 
+@app.route('weapons', methods=['GET'], auth_level=func.AuthLevel.ANONYMOUS)
+def HttpQueryWeapons(req: func.HttpRequest):
+    bungieId = req.params.get('bungie_id')
+    if not bungieId:
+        return func.HttpResponse("Missing required parameter: bungie_id", status_code=400)
+    if not user_token_matches(db, bungieId, bearer_token(req.headers.get('Authorization'))):
+        return func.HttpResponse("Invalid access token for this user.", status_code=401)
+
+    try:
+        min_score = float(req.params['min_score']) if 'min_score' in req.params else None
+        page_size = min(int(req.params.get('limit', USER_WEAPONS_PAGE_SIZE)), USER_WEAPONS_MAX_PAGE_SIZE)
+        after = decode_cursor(req.params['cursor']) if req.params.get('cursor') else None
+        projection = parse_projection(req.params.get('fields'))
+    except ValueError as e:
+        return func.HttpResponse(str(e), status_code=400)
+    if page_size < 1:
+        return func.HttpResponse("limit must be at least 1", status_code=400)
+
+    filters = weapon_filters(min_score, req.params.get('type'), req.params.get('character_id'), req.params.get('name'))
+    # Filtering, sorting and projection all run in Mongo against the UserWeapons indexes
+    weapons, next_after = find_user_weapons(db, bungieId, page_size, after, filters, projection)
+    return func.HttpResponse(json.dumps({'weapons': weapons, 'next_cursor': encode_cursor(next_after)}, cls=DateTimeEncoder),
+                             mimetype="application/json")
+
+
 async def run_async_inventory(db, bungieId, membershipType, destiny_membership_id,access_token):
     try:
         inventory = await GetInventory(db, bungieId, membershipType, destiny_membership_id, access_token)